@@ -0,0 +1,107 @@
+"""
+Text analysis shared by indexing and querying: tokenize, lowercase, remove stopwords (not for
+queries) and lemmatize. Lemmatizing is by far the most expensive step and a corpus has far fewer
+distinct tokens than token occurrences, so the lemma of every token is cached. The cache is saved
+with the index in analysis.json and loaded again with it. The file is only appended to: every save
+adds one line with the entries added since the previous save, so that adding a few documents does not
+rewrite the whole cache.
+"""
+import os
+import re
+import json
+from nltk.stem import WordNetLemmatizer
+
+
+class Analyzer:
+    # turns texts into lists of terms, keeping a token to term cache
+    # instances are sent once to every worker process, the cache entries added there are sent back
+    # with the results and merged into the cache of the indexing process
+
+    token_pattern = re.compile(r'\w+')  # same tokens as nltk's RegexpTokenizer(r'\w+')
+    max_entries = 2**20                 # the cache stops growing at this size
+
+    def __init__(self, stopwords, terms=None):
+        self.stopwords = frozenset(stopwords)
+        self.lemmatizer = WordNetLemmatizer()
+        self.terms = dict(terms or {})  # token to lemmatized term
+        self.new_terms = {}             # entries added since the last take_new_terms()
+        self.unsaved = {}               # entries added since the cache was last saved
+
+    def __getstate__(self):
+        return {'stopwords': self.stopwords, 'terms': self.terms}
+
+    def __setstate__(self, state):
+        self.__init__(state['stopwords'], state['terms'])
+
+    def lemmatize(self, token):
+        # cache miss: run the lemmatizer and remember the result
+        term = self.lemmatizer.lemmatize(token)
+        if len(self.terms) < self.max_entries:
+            self.terms[token] = term
+            self.new_terms[token] = term
+            self.unsaved[token] = term
+        return term
+
+    def analyze(self, text, query=False):
+        # list of terms of a text, stopwords are kept in queries
+        tokens = self.token_pattern.findall(text.lower())
+        if not query:
+            stopwords = self.stopwords
+            tokens = [token for token in tokens if token not in stopwords]
+        get, lemmatize = self.terms.get, self.lemmatize
+        return [get(token) or lemmatize(token) for token in tokens]
+
+    def analyze_batch(self, texts, query=False):
+        return [self.analyze(text, query) for text in texts]
+
+    def take_new_terms(self):
+        # cache entries added since the last call
+        new_terms, self.new_terms = self.new_terms, {}
+        return new_terms
+
+    def update(self, terms):
+        # merge cache entries computed by another analyzer
+        for token, term in terms.items():
+            if token not in self.terms and len(self.terms) < self.max_entries:
+                self.terms[token] = term
+                self.unsaved[token] = term
+
+    def save(self, path):
+        # append the entries added since the last save as a JSON object on a line of its own
+        # the line starts with the newline, so a line cut short by a crash never runs into the next one
+        if not self.unsaved:
+            return
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('\n' + json.dumps(self.unsaved))
+        self.unsaved = {}
+
+    @classmethod
+    def load(cls, path, stopwords):
+        # merge the lines of the cache file
+        # a line that does not parse was cut short while it was written, the cache just misses its entries
+        terms = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            terms.update(json.loads(line))
+                        except ValueError:
+                            pass
+        return cls(stopwords, terms)
+
+
+# analyzer of the current worker process, set up once by init_worker
+worker_analyzer = None
+
+
+def init_worker(analyzer):
+    global worker_analyzer
+    worker_analyzer = analyzer
+
+
+def analyze_in_worker(texts):
+    # analyze a batch of documents in a worker process, returns the terms of every text and the
+    # cache entries the batch added
+    analyzed = worker_analyzer.analyze_batch(texts)
+    return analyzed, worker_analyzer.take_new_terms()
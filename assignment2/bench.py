@@ -0,0 +1,388 @@
+"""
+Benchmarks for the search engine in main.py.
+    python bench.py                     component benchmarks against the index in ./ir.idx
+    python bench.py --suite [--docs N] [--out results.json] [--compare previous.json]
+                                        indexing throughput, index size, load time and query latency
+                                        percentiles on a deterministic synthetic corpus, saved as JSON
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from nltk.tokenize import RegexpTokenizer
+from nltk.stem import WordNetLemmatizer
+from nltk.corpus import stopwords
+from main import Indexer, SearchAgent, methods
+from analysis import Analyzer
+from cache import LRUCache
+from compression import codecs, encode_postings, CompressedPostings
+from boolean import intersect, intersect_naive
+
+# sample queries of different lengths used for all the query benchmarks
+queries = [
+    "president",
+    "world cup",
+    "white house",
+    "stock market crash",
+    "police arrested a man",
+    "the united nations security council vote",
+    "apple iphone sales in china",
+    "climate change and global warming report",
+]
+
+
+def time_per_query(score, cleaned_queries, repeat=3):
+    # run every query `repeat` times and return the mean latency in milliseconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for cleaned_query in cleaned_queries:
+            score(cleaned_query)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(cleaned_queries))
+
+
+def bench_scoring(agent):
+    # compare the posting-at-a-time dictionary scoring with term-at-a-time accumulator scoring and
+    # with the sparse matrix product, whose one-off build is timed separately
+    cleaned_queries = agent.indexer.clean_text(queries, query=True)
+
+    dict_ms = time_per_query(agent.calculate_bm25_scores, cleaned_queries)
+    taat_ms = time_per_query(agent.score_taat, cleaned_queries)
+    start = time.perf_counter()
+    matrix = agent.score_matrix()
+    build_seconds = time.perf_counter() - start
+    sparse_ms = time_per_query(lambda cq: matrix.scores([agent.query_terms(cq)]), cleaned_queries)
+
+    print(f'calculate_bm25_scores: {dict_ms:8.3f} ms/query')
+    print(f'score_taat:            {taat_ms:8.3f} ms/query ({dict_ms / taat_ms:.1f}x)')
+    print(f'sparse matrix:         {sparse_ms:8.3f} ms/query ({dict_ms / sparse_ms:.1f}x), '
+          f'built in {build_seconds:.2f} s, {matrix.weights.nnz} weights')
+
+
+def bench_topk(agent, k=5):
+    # compare exhaustive term-at-a-time scoring with WAND and Block-Max WAND top-k evaluation
+    cleaned_queries = agent.indexer.clean_text(queries, query=True)
+
+    taat_ms = time_per_query(agent.score_taat, cleaned_queries)
+    wand_ms = time_per_query(lambda cq: agent.score_daat(cq, k, block_max=False), cleaned_queries)
+    bmw_ms = time_per_query(lambda cq: agent.score_daat(cq, k, block_max=True), cleaned_queries)
+
+    print(f'top-{k} score_taat: {taat_ms:8.3f} ms/query')
+    print(f'top-{k} wand:       {wand_ms:8.3f} ms/query')
+    print(f'top-{k} bmw:        {bmw_ms:8.3f} ms/query')
+
+
+def bench_batch(agent, k=10, repeat=50, num_workers=4):
+    # throughput of query_batch against ranking the same queries one at a time
+    # the result cache would answer the repeated queries, so it is turned off here
+    result_cache, agent.result_cache = agent.result_cache, LRUCache(0)
+    batch = queries * repeat
+    start = time.perf_counter()
+    for q_str in batch:
+        agent.search(agent.indexer.clean_text([q_str], query=True)[0], k)
+    loop_qps = len(batch) / (time.perf_counter() - start)
+
+    print(f'one at a time:         {loop_qps:8.1f} queries/s')
+    print(f'query_batch:           {agent.query_batch(batch, k).qps:8.1f} queries/s')
+    agent.score_matrix()
+    print(f'query_batch sparse:    {agent.query_batch(batch, k, "sparse").qps:8.1f} queries/s')
+    print(f'query_batch {num_workers} workers: {agent.query_batch(batch, k, num_workers=num_workers).qps:8.1f} queries/s')
+    agent.result_cache = result_cache
+
+
+def bench_result_cache(agent, k=10, repeat=100):
+    # latency of analyzing and ranking a query on a result cache miss and on a hit
+    agent.result_cache.clear()
+    rank = lambda q_str: agent.search(agent.indexer.clean_text([q_str], query=True)[0], k)
+    miss_ms = time_per_query(rank, queries, repeat=1)
+    hit_ms = time_per_query(rank, queries, repeat=repeat)
+    print(f'result cache miss: {miss_ms * 1000:10.1f} us/query')
+    print(f'result cache hit:  {hit_ms * 1000:10.1f} us/query {agent.cache_stats()["results"]}')
+
+
+def bench_postings_cache(agent):
+    # term-at-a-time latency with every postings list decoded from the index and served from the postings cache
+    cleaned_queries = agent.indexer.clean_text(queries, query=True)
+    agent.indexer.postings_cache.clear()
+    cold_ms = time_per_query(agent.score_taat, cleaned_queries, repeat=1)
+    warm_ms = time_per_query(agent.score_taat, cleaned_queries)
+    print(f'postings cache cold: {cold_ms:8.3f} ms/query')
+    print(f'postings cache warm: {warm_ms:8.3f} ms/query {agent.cache_stats()["postings"]}')
+
+
+def bench_phrase(agent, k=10, window=8):
+    # latency of phrase and window queries against ranking the same words as a bag of words
+    # segments without positions verify the candidates with the forward index instead
+    phrases = [' '.join(agent.indexer.analyzer.analyze(q_str)) for q_str in queries if len(q_str.split()) > 1]
+    with_positions = sum(segment.has_positions for segment in agent.indexer.segments)
+    taat_ms = time_per_query(agent.score_taat, phrases)
+    phrase_ms = time_per_query(lambda cp: agent.search_phrase(cp, k), phrases)
+    window_ms = time_per_query(lambda cp: agent.search_phrase(cp, k, window), phrases)
+    print(f'{with_positions} of {len(agent.indexer.segments)} segments with positions')
+    print(f'bag of words:     {taat_ms:8.3f} ms/query')
+    print(f'phrase:           {phrase_ms:8.3f} ms/query')
+    print(f'window of {window:<3d}     {window_ms:8.3f} ms/query')
+
+
+def bench_boolean(agent, num_pairs=100, seed=0):
+    # AND of a rare and a common term: walking both lists side by side, np.intersect1d, binary searching
+    # the rare term's doc ids in the common term's, and the boolean query engine, which looks the rare
+    # term's documents up through the skip table of the common term without decoding the rest of it
+    indexer = agent.indexer
+    rng = random.Random(seed)
+    df = np.array([indexer.doc_freq(term_id) for term_id in range(len(indexer.idx2tok))])
+    by_df = [term_id for term_id in np.argsort(df, kind='stable').tolist() if df[term_id] > 0]
+    pairs = [(rng.choice(by_df[:len(by_df) // 2]), rng.choice(by_df[-100:])) for _ in range(num_pairs)]
+    arrays = [(indexer.get_postings(rare)[0], indexer.get_postings(common)[0]) for rare, common in pairs]
+    lists = [(rare.tolist(), common.tolist()) for rare, common in arrays]
+    print(f'{num_pairs} pairs, mean df {np.mean([len(a) for a, _ in arrays]):.1f} AND {np.mean([len(b) for _, b in arrays]):.1f}')
+
+    runs = [
+        ('naive merge', lambda: [intersect_naive(a, b) for a, b in lists]),
+        ('np.intersect1d', lambda: [np.intersect1d(a, b, assume_unique=True) for a, b in arrays]),
+        ('searchsorted', lambda: [intersect(a, b) for a, b in arrays]),
+    ]
+    for name, run in runs:
+        start = time.perf_counter()
+        run()
+        print(f'{name:16s} {(time.perf_counter() - start) * 1e6 / num_pairs:10.1f} us/pair')
+
+    # the engine decodes and ranks as well, with cold and then warm postings cache
+    q_strs = [f'{indexer.idx2tok[rare]} AND {indexer.idx2tok[common]}' for rare, common in pairs]
+    indexer.postings_cache.clear()
+    cold_ms = time_per_query(agent.search_boolean, q_strs, repeat=1)
+    warm_ms = time_per_query(agent.search_boolean, q_strs)
+    print(f'search_boolean   {cold_ms * 1000:10.1f} us/query cold, {warm_ms * 1000:.1f} us/query warm')
+
+
+def bench_codecs(indexer):
+    # report the size and whole-list decode throughput of every postings codec on the same postings
+    postings = [indexer.get_postings(term_id) for term_id in range(len(indexer.idx2tok))]
+    num_postings = sum(len(doc_ids) for doc_ids, _ in postings)
+    raw_bytes = sum(doc_ids.nbytes + tfs.nbytes for doc_ids, tfs in postings)
+    print(f'{num_postings} postings, {raw_bytes / 2**20:.1f} MiB as int32 arrays')
+
+    for name, codec in codecs.items():
+        encoded = [encode_postings(doc_ids, tfs, codec, indexer.block_size) for doc_ids, tfs in postings]
+        size = sum(len(data) for data in encoded)
+
+        start = time.perf_counter()
+        for data in encoded:
+            CompressedPostings(data, codec).decode()
+        seconds = time.perf_counter() - start
+
+        print(f'{name:8s} {size / 2**20:8.1f} MiB ({raw_bytes / size:.1f}x smaller), '
+              f'{size * 8 / num_postings:.1f} bits/posting, decode {num_postings / seconds / 1e6:.1f}M postings/s')
+
+
+def analyze_uncached(texts, stopwords):
+    # the analysis as it was before Analyzer: stopwords in a list, every token occurrence lemmatized
+    tokenizer = RegexpTokenizer(r'\w+')
+    lemmatizer = WordNetLemmatizer()
+    analyzed = []
+    for text in texts:
+        tokens = tokenizer.tokenize(text.lower())
+        tokens = [token for token in tokens if token not in stopwords]
+        analyzed.append([lemmatizer.lemmatize(token) for token in tokens])
+    return analyzed
+
+
+def bench_analysis(indexer, num_docs=2000):
+    # compare the analysis throughput without cache, with an empty cache and with the cache saved in the index
+    documents = []
+    for segment in indexer.segments:
+        documents += [segment.document(local_id) for local_id in range(min(segment.num_docs, num_docs - len(documents)))]
+    num_tokens = sum(len(document.split()) for document in documents)
+
+    runs = [
+        ('uncached', lambda: analyze_uncached(documents, list(indexer.stopwords))),
+        ('cold cache', lambda: Analyzer(indexer.stopwords).analyze_batch(documents)),
+        ('index cache', lambda: Analyzer(indexer.stopwords, indexer.analyzer.terms).analyze_batch(documents)),
+    ]
+    for name, run in runs:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        print(f'{name:12s} {len(documents) / seconds:10.0f} docs/s {num_tokens / seconds / 1e6:6.2f}M tokens/s')
+
+
+def synthetic_corpus(num_docs, vocab_size=20000, seed=0):
+    # deterministic corpus of pronounceable made-up words with Zipf distributed frequencies,
+    # mixed with English stopwords, and document lengths spread like news articles
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiou']
+    vocabulary = set()
+    while len(vocabulary) < vocab_size:
+        vocabulary.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 4))))
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    vocabulary += ['the', 'a', 'of', 'and', 'to', 'in', 'is', 'was', 'for', 'on']
+    cum_weights = np.cumsum(1.0 / np.arange(1, len(vocabulary) + 1)).tolist()
+
+    documents = []
+    for _ in range(num_docs):
+        length = min(int(rng.lognormvariate(6.0, 0.6)), 3000)
+        documents.append(' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length)))
+    return documents
+
+
+def percentiles(seconds):
+    # latency summary in milliseconds
+    ms = np.asarray(seconds) * 1000
+    return {'count': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def suite_queries(indexer, num_queries, seed=0):
+    # queries grouped by number of terms and by the document frequency of their terms, terms are
+    # drawn from the lexicon split into low, medium and high df thirds
+    rng = random.Random(seed)
+    terms = indexer.idx2tok
+    df = np.array([indexer.doc_freq(term_id) for term_id in range(len(terms))])
+    by_df = [terms[i] for i in np.argsort(df, kind='stable') if df[i] > 0]
+    thirds = {'low_df': by_df[:len(by_df) // 3], 'mid_df': by_df[len(by_df) // 3:2 * len(by_df) // 3],
+              'high_df': by_df[2 * len(by_df) // 3:]}
+
+    groups = {}
+    for length in (1, 2, 3, 5):
+        groups[f'{length}_terms'] = [' '.join(rng.choices(by_df, k=length)) for _ in range(num_queries)]
+    for name, pool in thirds.items():
+        groups[name] = [' '.join(rng.choices(pool, k=2)) for _ in range(num_queries)]
+    return groups
+
+
+def run_suite(num_docs=5000, num_queries=200, k=10, seed=0):
+    # build, load and query an index of a synthetic corpus in a temporary directory
+    results = {
+        'config': {'num_docs': num_docs, 'num_queries': num_queries, 'k': k, 'seed': seed,
+                   'postings_codec': Indexer.postings_codec, 'positions': Indexer.positions,
+                   'num_workers': Indexer.num_workers},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+    }
+    documents = synthetic_corpus(num_docs, seed=seed)
+    num_tokens = sum(len(document.split()) for document in documents)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    bench_indexer = type('BenchIndexer', (Indexer,), {'dbfile': os.path.join(workdir, 'ir.idx')})
+    try:
+        # analysis alone with an empty token cache, then a full index build from scratch
+        results['indexing'] = {}
+        start = time.perf_counter()
+        Analyzer(stopwords.words('english')).analyze_batch(documents)
+        seconds = time.perf_counter() - start
+        results['indexing']['clean_text'] = {'docs_per_s': num_docs / seconds, 'tokens_per_s': num_tokens / seconds}
+
+        start = time.perf_counter()
+        bench_indexer(documents)
+        seconds = time.perf_counter() - start
+        results['indexing']['build'] = {'docs_per_s': num_docs / seconds, 'tokens_per_s': num_tokens / seconds,
+                                        'seconds': seconds}
+
+        # index size on disk, then load time and memory allocated by loading
+        tracemalloc.start()
+        start = time.perf_counter()
+        indexer = bench_indexer()
+        load_seconds = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results['index'] = {'disk_bytes': directory_size(indexer.dbfile), 'ram_bytes': current,
+                            'ram_peak_bytes': peak, 'load_seconds': load_seconds,
+                            'num_terms': len(indexer.idx2tok), 'num_segments': len(indexer.segments),
+                            'num_tokens': int(indexer.corpus_stats['total_length'])}
+
+        # query latency per group and method, without the result cache that would answer repeats
+        agent = SearchAgent(indexer)
+        agent.result_cache = LRUCache(0)
+        start = time.perf_counter()
+        agent.score_matrix()
+        results['index']['matrix_build_seconds'] = time.perf_counter() - start
+        results['queries'] = {}
+        for group, group_queries in suite_queries(indexer, num_queries, seed).items():
+            results['queries'][group] = {}
+            for method in methods:
+                indexer.postings_cache.clear()
+                latencies = []
+                for q_str in group_queries:
+                    start = time.perf_counter()
+                    agent.search(indexer.clean_text([q_str], query=True)[0], k, method)
+                    latencies.append(time.perf_counter() - start)
+                results['queries'][group][method] = percentiles(latencies)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def flatten(results, prefix=''):
+    # numeric leaves of a results dictionary keyed by their path
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(previous, current):
+    # print every measurement of two suite runs side by side with the relative change
+    before, after = flatten(previous), flatten(current)
+    for key in sorted(after):
+        if key in before and not key.startswith(('config.', 'environment.')):
+            change = (after[key] / before[key] - 1) * 100 if before[key] else float('nan')
+            print(f'{key:40s} {before[key]:14.3f} {after[key]:14.3f} {change:+8.1f}%')
+
+
+def print_suite(results):
+    for stage, values in results['indexing'].items():
+        print(f'{stage:12s} {values["docs_per_s"]:10.0f} docs/s {values["tokens_per_s"] / 1e6:6.2f}M tokens/s')
+    index = results['index']
+    print(f'index        {index["disk_bytes"] / 2**20:.1f} MiB on disk, {index["ram_bytes"] / 2**20:.1f} MiB in RAM, '
+          f'loaded in {index["load_seconds"] * 1000:.1f} ms')
+    for group, methods in results['queries'].items():
+        print(f'{group:12s} ' + '  '.join(f'{method} p50 {values["p50_ms"]:7.3f} p99 {values["p99_ms"]:7.3f} ms'
+                                          for method, values in methods.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='search engine benchmarks')
+    parser.add_argument('--suite', action='store_true', help='run the suite on a synthetic corpus instead of ./ir.idx')
+    parser.add_argument('--docs', type=int, default=5000, help='number of synthetic documents')
+    parser.add_argument('--queries', type=int, default=200, help='number of queries per group')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the suite results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous suite run to compare with')
+    args = parser.parse_args()
+
+    if args.suite:
+        previous = None
+        if args.compare:
+            with open(args.compare) as f:
+                previous = json.load(f)
+        results = run_suite(args.docs, args.queries, seed=args.seed)
+        print_suite(results)
+        if previous is not None:
+            compare(previous, results)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+    else:
+        i = Indexer()
+        q = SearchAgent(i)
+        bench_scoring(q)
+        bench_topk(q)
+        bench_batch(q)
+        bench_result_cache(q)
+        bench_postings_cache(q)
+        bench_phrase(q)
+        bench_boolean(q)
+        bench_codecs(i)
+        bench_analysis(i)
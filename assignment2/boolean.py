@@ -0,0 +1,114 @@
+"""
+Boolean queries: the query syntax and the intersection of increasing doc id arrays.
+
+    white house                         documents holding both terms, operands next to each other are ANDed
+    obama AND (senate OR congress)      parentheses group
+    election NOT "white house"          NOT excludes, quotes match the words as a phrase
+NOT binds tighter than AND, which binds tighter than OR. Operators are only recognized in upper
+case, so "and", "or" and "not" in lower case are ordinary words.
+
+parse_query() turns a query into nested tuples of
+    ('term', text)  ('phrase', text)  ('not', node)  ('and', [nodes])  ('or', [nodes])
+that SearchAgent.search_boolean analyzes and evaluates segment by segment. Boolean queries are asked
+for explicitly, with SearchAgent.query(q_str, mode='boolean') or /search?mode=boolean in server.py;
+queries are otherwise ranked as a bag of words whatever characters they hold.
+"""
+import re
+import numpy as np
+
+token_pattern = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+operators = ('AND', 'OR', 'NOT')
+
+
+class QueryParser:
+    # recursive descent parser of the boolean query syntax
+
+    def __init__(self, q_str):
+        self.tokens = token_pattern.findall(q_str)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if self.peek() is None:
+            raise ValueError('empty query')
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f'unexpected {self.peek()!r} in query')
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() not in (None, ')', 'OR'):
+            if self.peek() == 'AND':
+                self.take()
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.take()
+            return 'not', self.parse_not()
+        return self.parse_operand()
+
+    def parse_operand(self):
+        token = self.take()
+        if token is None or token in operators or token == ')':
+            raise ValueError(f'missing operand {"at the end" if token is None else "before " + repr(token)} of query')
+        if token == '(':
+            node = self.parse_or()
+            if self.take() != ')':
+                raise ValueError('missing ) in query')
+            return node
+        if token[0] == '"':
+            return 'phrase', token.strip('"')
+        return 'term', token
+
+
+def parse_query(q_str):
+    return QueryParser(q_str).parse()
+
+
+def contains_sorted(sorted_values, values):
+    # boolean mask of the values found in an increasing array, one binary search per value
+    found = np.searchsorted(sorted_values, values)
+    inside = found < len(sorted_values)
+    inside[inside] = sorted_values[found[inside]] == values[inside]
+    return inside
+
+
+def intersect(a, b):
+    # values in both increasing arrays, every value of the shorter array is binary searched in the
+    # longer one, so the cost is O(short * log long) however long the longer array is
+    if len(a) > len(b):
+        a, b = b, a
+    return a[contains_sorted(b, a)]
+
+
+def intersect_naive(a, b):
+    # values in both increasing lists by walking them side by side, O(a + b)
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
@@ -0,0 +1,154 @@
+"""
+Caches shared by the index and the search agent.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class LRUCache:
+    # size-bounded least-recently-used cache with hit/miss counters, safe to share between threads
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'capacity': self.capacity}
+
+
+class FrequencySketch:
+    # count-min sketch of how often keys were accessed recently, with small saturating counters that
+    # are all halved after sample_size accesses so that old popularity fades out
+
+    def __init__(self, width=4096, depth=4, max_count=15):
+        self.width = width
+        self.depth = depth
+        self.max_count = max_count
+        self.counters = np.zeros((depth, width), dtype=np.uint8)
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _slots(self, key):
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key):
+        rows = np.arange(self.depth)
+        slots = self._slots(key)
+        counts = self.counters[rows, slots]
+        self.counters[rows, slots] = np.minimum(counts + 1, self.max_count)
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.counters >>= 1
+            self.additions //= 2
+
+    def estimate(self, key):
+        return int(self.counters[np.arange(self.depth), self._slots(key)].min())
+
+
+class TinyLFUCache:
+    # byte-bounded cache with least-recently-used eviction and TinyLFU admission: when a new entry
+    # only fits by evicting others, it is admitted only if it was accessed more often recently than
+    # the entries it would evict, so a burst of one-off keys cannot flush out the popular ones
+
+    def __init__(self, max_bytes, sketch_width=4096):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key to (value, size in bytes), least recently used first
+        self.bytes = 0
+        self.sketch = FrequencySketch(sketch_width)
+        self.hits = 0
+        self.misses = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            self.sketch.add(key)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        # offer an entry to the cache, returns whether it was admitted
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            if key in self.entries:
+                return True
+
+            # least recently used entries that would have to go to make room
+            victims = []
+            free = self.max_bytes - self.bytes
+            for victim, (_, victim_size) in self.entries.items():
+                if free >= size:
+                    break
+                victims.append(victim)
+                free += victim_size
+
+            if victims:
+                frequency = self.sketch.estimate(key)
+                if any(self.sketch.estimate(victim) >= frequency for victim in victims):
+                    self.rejected += 1
+                    return False
+                for victim in victims:
+                    self.bytes -= self.entries.pop(victim)[1]
+                self.evicted += len(victims)
+
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self.admitted += 1
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'bytes': self.bytes,
+                'max_bytes': self.max_bytes, 'admitted': self.admitted, 'rejected': self.rejected,
+                'evicted': self.evicted}
@@ -0,0 +1,272 @@
+"""
+Compressed postings lists: d-gap encoding with variable-byte or bit-packed block codecs.
+
+A compressed postings list is laid out as
+    header      count, number of blocks, block size
+    skip table  last doc id of every block (as gaps), byte length of the doc gap and tf section of every block
+    payload     per block: doc gaps section, then term frequencies section
+The header and skip table are always variable-byte coded, the payload uses the chosen codec.
+Doc ids are stored as gaps minus one (the first gap of a block is taken from the last doc id of the
+previous block) and term frequencies as tf minus one, so both start at zero.
+Term positions are kept apart from the postings (see encode_positions) so that queries without
+phrases never read them.
+"""
+import numpy as np
+
+
+def vbyte_lengths(values):
+    # number of bytes of every value in the variable-byte code, at most 5 for 32 bit values
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        nbytes += values >= (1 << shift)
+    return nbytes
+
+
+class VByteCodec:
+    # variable-byte codec: 7 bits per byte, least significant group first, high bit marks the last byte
+    name = 'vbyte'
+
+    def encode(self, values):
+        values = np.asarray(values, dtype=np.uint64)
+        if len(values) == 0:
+            return b''
+
+        nbytes = vbyte_lengths(values)
+        starts = np.cumsum(nbytes) - nbytes
+
+        out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+        for j in range(5):
+            mask = nbytes > j
+            out[starts[mask] + j] = (values[mask] >> np.uint64(7 * j)) & np.uint64(0x7f)
+        out[starts + nbytes - 1] |= 0x80
+        return out.tobytes()
+
+    def decode(self, data, count=None):
+        data = np.frombuffer(data, dtype=np.uint8)
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.uint32)
+
+        # every value ends at a byte with the high bit set
+        ends = np.flatnonzero(data & 0x80)[:count]
+        if len(ends) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        data = data[:ends[-1] + 1]
+        starts = np.concatenate(([0], ends[:-1] + 1))
+
+        # shift the 7 bit groups into place and add up the groups of every value
+        group = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+        shifted = (data & 0x7f).astype(np.uint64) << (7 * group).astype(np.uint64)
+        return np.add.reduceat(shifted, starts).astype(np.uint32)
+
+    def decode_sections(self, data, offsets, counts):
+        # decode consecutive sections in one pass, the byte stream is self-delimiting
+        return self.decode(data[offsets[0]:offsets[-1]])
+
+
+class BitPackCodec:
+    # bit-packed codec: a one byte bit width followed by every value packed in exactly that many bits
+    name = 'bitpack'
+
+    def encode(self, values):
+        values = np.asarray(values, dtype=np.uint64)
+        if len(values) == 0:
+            return b''
+        width = int(values.max()).bit_length()
+        if width == 0:
+            return bytes([0])
+        bits = (values[:, None] >> np.arange(width, dtype=np.uint64)) & np.uint64(1)
+        return bytes([width]) + np.packbits(bits.astype(np.uint8).ravel(), bitorder='little').tobytes()
+
+    def decode(self, data, count):
+        data = np.frombuffer(data, dtype=np.uint8)
+        if count == 0 or len(data) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        width = int(data[0])
+        if width == 0:
+            return np.zeros(count, dtype=np.uint32)
+        bits = np.unpackbits(data[1:], count=count * width, bitorder='little').reshape(count, width)
+        weights = np.uint64(1) << np.arange(width, dtype=np.uint64)
+        return (bits.astype(np.uint64) * weights).sum(axis=1).astype(np.uint32)
+
+    def decode_sections(self, data, offsets, counts):
+        return np.concatenate([self.decode(data[start:end], count)
+                               for start, end, count in zip(offsets[:-1], offsets[1:], counts)])
+
+
+codecs = {codec.name: codec for codec in (VByteCodec(), BitPackCodec())}
+
+
+def encode_postings(doc_ids, tfs, codec, block_size=128):
+    # compress a postings list given as sorted doc ids and their term frequencies
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    count = len(doc_ids)
+    num_blocks = (count + block_size - 1) // block_size
+
+    gaps = np.diff(doc_ids, prepend=-1) - 1
+    last_docs = doc_ids[np.minimum(np.arange(1, num_blocks + 1) * block_size, count) - 1]
+
+    sections = []
+    for start in range(0, count, block_size):
+        sections.append(codec.encode(gaps[start:start + block_size]))
+        sections.append(codec.encode(tfs[start:start + block_size] - 1))
+
+    header = np.concatenate(([count, num_blocks, block_size], np.diff(last_docs, prepend=0),
+                             [len(section) for section in sections]))
+    return b''.join([codecs['vbyte'].encode(header)] + sections)
+
+
+def postings_blocks(counts, block_size):
+    # block layout of postings lists given back to back with counts[i] postings each:
+    # (number of blocks of every list, index of the first posting of every block)
+    counts = np.asarray(counts, dtype=np.int64)
+    num_blocks = (counts + block_size - 1) // block_size
+    list_starts = np.cumsum(counts) - counts
+    first_blocks = np.cumsum(num_blocks) - num_blocks
+    block_in_list = np.arange(int(num_blocks.sum())) - np.repeat(first_blocks, num_blocks)
+    return num_blocks, np.repeat(list_starts, num_blocks) + block_in_list * block_size
+
+
+def encode_postings_batch(doc_ids, tfs, counts, codec, block_size=128):
+    # encode_postings() of many postings lists given back to back, counts[i] postings each and at least
+    # one, returned as (concatenated compressed lists, byte size of every list)
+    # with the variable-byte codec the values of all the lists are laid out in their final order and
+    # coded in one vectorized pass, so the cost does not grow with the number of lists; a small segment
+    # is mostly made of lists of one or two postings
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    list_starts = np.cumsum(counts) - counts
+    if codec.name != 'vbyte':
+        lists = [encode_postings(doc_ids[start:start + count], tfs[start:start + count], codec, block_size)
+                 for start, count in zip(list_starts.tolist(), counts.tolist())]
+        return b''.join(lists), np.array([len(data) for data in lists], dtype=np.int64)
+
+    num_blocks, block_starts = postings_blocks(counts, block_size)
+    block_lists = np.repeat(np.arange(len(counts)), num_blocks)
+    block_in_list = (block_starts - list_starts[block_lists]) // block_size
+    first_blocks = np.cumsum(num_blocks) - num_blocks
+
+    # doc gaps minus one and the skip table values, both restarting at every list
+    gaps = np.diff(doc_ids, prepend=-1) - 1
+    gaps[list_starts] = doc_ids[list_starts]
+    last_docs = doc_ids[np.append(block_starts[1:], len(doc_ids)) - 1]
+    last_gaps = np.diff(last_docs, prepend=0)
+    last_gaps[first_blocks] = last_docs[first_blocks]
+    gap_bytes = np.add.reduceat(vbyte_lengths(gaps), block_starts)
+    tf_bytes = np.add.reduceat(vbyte_lengths(tfs - 1), block_starts)
+
+    # every list is its header (count, number of blocks, block size, skip table) then its payload
+    list_lengths = 3 + 3 * num_blocks + 2 * counts
+    list_offsets = np.cumsum(list_lengths) - list_lengths
+    values = np.empty(int(list_lengths.sum()), dtype=np.uint64)
+    values[list_offsets] = counts
+    values[list_offsets + 1] = num_blocks
+    values[list_offsets + 2] = block_size
+    skip_table = list_offsets[block_lists] + 3
+    values[skip_table + block_in_list] = last_gaps
+    values[skip_table + num_blocks[block_lists] + 2 * block_in_list] = gap_bytes
+    values[skip_table + num_blocks[block_lists] + 2 * block_in_list + 1] = tf_bytes
+
+    # payload: the doc gaps of every block followed by its term frequencies
+    posting_lists = np.repeat(np.arange(len(counts)), counts)
+    in_list = np.arange(len(doc_ids)) - list_starts[posting_lists]
+    block, in_block = in_list // block_size, in_list % block_size
+    block_lengths = np.minimum(block_size, counts[posting_lists] - block * block_size)
+    gap_positions = list_offsets[posting_lists] + 3 + 3 * num_blocks[posting_lists] + 2 * block * block_size + in_block
+    values[gap_positions] = gaps
+    values[gap_positions + block_lengths] = tfs - 1
+
+    sizes = np.add.reduceat(vbyte_lengths(values), list_offsets)
+    return codec.encode(values), sizes
+
+
+def encode_positions(positions, tfs, block_size=128):
+    # variable-byte coded term positions of a postings list, one section per block of postings so that
+    # the positions of a few documents can be decoded without the rest of the list
+    # positions holds the increasing positions of every posting back to back, the first position of a
+    # posting is stored as is and the others as gaps minus one
+    positions = np.asarray(positions, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    ends = np.cumsum(tfs)
+    starts = ends - tfs
+    gaps = np.diff(positions, prepend=0) - 1
+    gaps[starts] = positions[starts]
+
+    count = len(tfs)
+    edges = np.concatenate(([0], ends))[np.append(np.arange(0, count, block_size), count)]
+    vbyte = codecs['vbyte']
+    return [vbyte.encode(gaps[start:end]) for start, end in zip(edges[:-1], edges[1:])]
+
+
+def decode_positions(data, tfs):
+    # decode one section of encode_positions() into (offsets, positions), the positions of the i-th
+    # posting of the block are positions[offsets[i]:offsets[i + 1]]
+    tfs = np.asarray(tfs, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(tfs)))
+    values = codecs['vbyte'].decode(data, int(offsets[-1])).astype(np.int64) + 1
+    starts = offsets[:-1]
+    values[starts] -= 1
+
+    # prefix sums restarted at the first position of every posting
+    sums = np.cumsum(values)
+    positions = sums - np.repeat(sums[starts] - values[starts], tfs)
+    return offsets, positions.astype(np.int32)
+
+
+class CompressedPostings:
+    # read-only view of a compressed postings list that can be decoded whole, streamed block by
+    # block, or entered at any block through the skip table
+
+    def __init__(self, data, codec):
+        self.data = np.frombuffer(data, dtype=np.uint8)
+        self.codec = codec
+        vbyte = codecs['vbyte']
+        self.count, self.num_blocks, self.block_size = (int(x) for x in vbyte.decode(self.data[:15], 3))
+
+        # decode the skip table, every header value takes at most 5 bytes
+        num_values = 3 + 3 * self.num_blocks
+        header_end = int(np.flatnonzero(self.data[:5 * num_values] & 0x80)[num_values - 1]) + 1
+        header = vbyte.decode(self.data[:header_end]).astype(np.int64)
+        self.block_last_docs = np.cumsum(header[3:3 + self.num_blocks])
+        self.offsets = np.concatenate(([0], np.cumsum(header[3 + self.num_blocks:])))
+        self.payload = self.data[header_end:]
+
+    def __len__(self):
+        return self.count
+
+    def block_length(self, block):
+        return min(self.block_size, self.count - block * self.block_size)
+
+    def find_block(self, doc_id):
+        # index of the first block whose last doc id is >= doc_id, num_blocks if there is none
+        return int(np.searchsorted(self.block_last_docs, doc_id))
+
+    def block(self, block):
+        # decode one block into (doc ids, term frequencies) arrays
+        n = self.block_length(block)
+        start, middle, end = self.offsets[2 * block:2 * block + 3]
+        gaps = self.codec.decode(self.payload[start:middle], n)
+        tfs = self.codec.decode(self.payload[middle:end], n)
+        first = int(self.block_last_docs[block - 1]) + 1 if block else 0
+        doc_ids = first + np.cumsum(gaps, dtype=np.int64) + np.arange(n)
+        return doc_ids.astype(np.int32), tfs.astype(np.int32) + 1
+
+    def blocks(self):
+        # stream the postings one decoded block at a time
+        for block in range(self.num_blocks):
+            yield self.block(block)
+
+    def decode(self):
+        # decode the whole list into (doc ids, term frequencies) arrays
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        counts = np.repeat([self.block_length(block) for block in range(self.num_blocks)], 2)
+        values = self.codec.decode_sections(self.payload, self.offsets, counts)
+
+        # split the interleaved sections back into doc gaps and term frequencies
+        is_gap = np.repeat(np.tile([True, False], self.num_blocks), counts)
+        gaps = values[is_gap].astype(np.int64)
+        tfs = values[~is_gap].astype(np.int32) + 1
+        doc_ids = np.cumsum(gaps + 1) - 1
+        return doc_ids.astype(np.int32), tfs
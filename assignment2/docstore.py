@@ -0,0 +1,104 @@
+"""
+Document store: raw document text compressed in blocks, fetched by doc id on demand.
+    docs.bin            compressed blocks back to back
+    doc_blocks.npy      byte offset of every compressed block in docs.bin, plus the end offset
+    block_docs.npy      first doc id of every block, plus the number of documents
+    doc_offsets.npy     offset of every document in the uncompressed stream of all documents, plus the end offset
+    docs.json           compression method and block size
+Only a small LRU cache of decompressed blocks is kept in memory.
+"""
+import os
+import json
+import zlib
+import lzma
+import numpy as np
+from cache import LRUCache
+
+compressors = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+def map_file(path):
+    # memory-map a binary file read-only, np.memmap cannot map empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class DocStoreWriter:
+    # appends documents to a new document store, compressing them into blocks of about block_bytes of text
+
+    def __init__(self, path, compression='zlib', block_bytes=64 * 1024):
+        self.path = path
+        self.compression = compression
+        self.compress, _ = compressors[compression]
+        self.block_bytes = block_bytes
+        self.file = open(os.path.join(path, 'docs.bin'), 'wb')
+        self.doc_offsets = [0]
+        self.block_docs = [0]
+        self.block_offsets = [0]
+        self.block = []
+        self.block_size = 0
+
+    def _flush(self):
+        data = self.compress(b''.join(self.block))
+        self.file.write(data)
+        self.block_offsets.append(self.block_offsets[-1] + len(data))
+        self.block_docs.append(len(self.doc_offsets) - 1)
+        self.block = []
+        self.block_size = 0
+
+    def add(self, document):
+        data = document.encode('utf-8')
+        self.block.append(data)
+        self.block_size += len(data)
+        self.doc_offsets.append(self.doc_offsets[-1] + len(data))
+        if self.block_size >= self.block_bytes:
+            self._flush()
+
+    def close(self):
+        if self.block:
+            self._flush()
+        self.file.close()
+        np.save(os.path.join(self.path, 'doc_blocks.npy'), np.array(self.block_offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'block_docs.npy'), np.array(self.block_docs, dtype=np.int64))
+        np.save(os.path.join(self.path, 'doc_offsets.npy'), np.array(self.doc_offsets, dtype=np.int64))
+        with open(os.path.join(self.path, 'docs.json'), 'w') as f:
+            json.dump({'compression': self.compression, 'block_bytes': self.block_bytes}, f)
+
+
+class DocStore:
+    # read-only document store, decompressed blocks are kept in a small LRU cache
+
+    def __init__(self, path, cache_blocks=16):
+        with open(os.path.join(path, 'docs.json')) as f:
+            self.meta = json.load(f)
+        _, self.decompress = compressors[self.meta['compression']]
+        self.data = map_file(os.path.join(path, 'docs.bin'))
+        self.block_offsets = np.load(os.path.join(path, 'doc_blocks.npy'), mmap_mode='r')
+        self.block_docs = np.load(os.path.join(path, 'block_docs.npy'), mmap_mode='r')
+        self.doc_offsets = np.load(os.path.join(path, 'doc_offsets.npy'), mmap_mode='r')
+        self.cache = LRUCache(cache_blocks)
+
+    def __len__(self):
+        return len(self.doc_offsets) - 1
+
+    def _block(self, block):
+        data = self.cache.get(block)
+        if data is None:
+            start, end = self.block_offsets[block], self.block_offsets[block + 1]
+            data = self.decompress(bytes(self.data[start:end]))
+            self.cache.put(block, data)
+        return data
+
+    def get(self, doc_id):
+        # raw text of a document
+        if not 0 <= doc_id < len(self):
+            raise IndexError(f'doc id out of range: {doc_id}')
+        block = int(np.searchsorted(self.block_docs, doc_id, side='right')) - 1
+        block_start = self.doc_offsets[self.block_docs[block]]
+        start = self.doc_offsets[doc_id] - block_start
+        end = self.doc_offsets[doc_id + 1] - block_start
+        return self._block(block)[start:end].decode('utf-8')
@@ -0,0 +1,133 @@
+"""
+Per-stage timings and counters of queries and index builds.
+
+Code paths take a stats object and call stats.clock() / stats.lap(stage, since) around their stages
+and stats.count(name, n) for their counters. When instrumentation is off they get NULL_STATS, whose
+methods do nothing, so the cost is one no-op method call per hook.
+"""
+import math
+import time
+
+
+class Stats:
+    # timings in seconds per stage and counters of one query or one index build
+    enabled = True
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def clock(self):
+        return time.perf_counter()
+
+    def lap(self, stage, since):
+        # add the time since `since` to a stage and return the current time, to start the next stage
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - since
+        return now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def as_dict(self):
+        return {'timings_ms': {stage: seconds * 1000 for stage, seconds in self.timings.items()},
+                'total_ms': self.total() * 1000, 'counters': dict(self.counters)}
+
+    def __repr__(self):
+        stages = ', '.join(f'{stage} {seconds * 1000:.3f} ms' for stage, seconds in self.timings.items())
+        counters = ', '.join(f'{name} {n}' for name, n in self.counters.items())
+        return f'Stats({stages}; {counters})'
+
+
+class NullStats:
+    # stands in for Stats when instrumentation is off
+    enabled = False
+    timings = {}
+    counters = {}
+
+    def clock(self):
+        return 0.0
+
+    def lap(self, stage, since):
+        return 0.0
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class Histogram:
+    # latency histogram with logarithmic buckets, four per doubling from 1 microsecond, so any
+    # percentile is known within 19% without storing the individual values
+
+    buckets_per_doubling = 4
+    num_buckets = 4 * 38    # up to about 2**38 microseconds
+
+    def __init__(self):
+        self.counts = [0] * self.num_buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def bucket(self, seconds):
+        microseconds = seconds * 1e6
+        if microseconds <= 1.0:
+            return 0
+        return min(int(math.log2(microseconds) * self.buckets_per_doubling) + 1, self.num_buckets - 1)
+
+    def upper_bound(self, bucket):
+        # largest value in seconds that falls into a bucket
+        return 2 ** (bucket / self.buckets_per_doubling) / 1e6
+
+    def add(self, seconds):
+        self.counts[self.bucket(seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, in seconds
+        if not self.count:
+            return float('nan')
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.upper_bound(bucket)
+        return self.upper_bound(self.num_buckets - 1)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean_ms': self.sum / self.count * 1000,
+                'p50_ms': self.percentile(50) * 1000, 'p90_ms': self.percentile(90) * 1000,
+                'p99_ms': self.percentile(99) * 1000}
+
+
+class StageHistograms:
+    # histograms of every stage and of the total time, plus summed counters, over many Stats
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, stats):
+        for stage, seconds in stats.timings.items():
+            self._histogram(stage).add(seconds)
+        self._histogram('total').add(stats.total())
+        for name, n in stats.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        return histogram
+
+    def summary(self):
+        return {'stages': {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+                'counters': dict(self.counters)}
@@ -0,0 +1,79 @@
+"""
+Load generator for server.py: many concurrent keep-alive clients send /search requests and the
+latency percentiles and throughput are reported at the end.
+
+    python loadgen.py [--url http://127.0.0.1:8080] [--concurrency 32] [--requests 2000] [--k 10] [--method taat]
+"""
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit, urlencode
+from bench import queries
+from main import methods
+
+
+def percentile(sorted_values, p):
+    # nearest-rank percentile of a sorted list
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+async def client(host, port, targets, latencies, errors):
+    # one keep-alive connection sending requests until no targets are left
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while targets:
+            target = targets.pop()
+            start = time.perf_counter()
+            writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            status = int(lines[0].split()[1])
+            length = 0
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(url, concurrency, num_requests, k, method, seed=0):
+    address = urlsplit(url)
+    rng = random.Random(seed)
+    targets = ['/search?' + urlencode({'q': rng.choice(queries), 'k': k, 'method': method})
+               for _ in range(num_requests)]
+    latencies = []
+    errors = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(address.hostname, address.port or 80, targets, latencies, errors)
+                           for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f'{len(latencies)} requests, {concurrency} clients, {len(errors)} errors, {len(latencies) / elapsed:.1f} requests/s')
+    for p in (50, 90, 99):
+        print(f'p{p:<3d} {percentile(latencies, p) * 1000:8.2f} ms')
+    print(f'max  {latencies[-1] * 1000:8.2f} ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='load generator for server.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--method', default='taat', choices=methods)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.concurrency, args.requests, args.k, args.method))
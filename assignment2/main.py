@@ -1,219 +1,1556 @@
 """
 Simple indexer and search engine built on an inverted-index and the BM25 ranking algorithm.
+
+    python main.py [--dbfile ./ir.idx] [--jsonl corpus.jsonl] [--field article]
+
+A new index is built from the cnn_dailymail dataset, or from the field of every record of a JSON lines
+file with --jsonl, streamed either way. An existing index is opened as it is.
 """
 import os
-from collections import defaultdict
-import pickle
+import json
+import shutil
+import threading
+from collections import defaultdict, Counter, deque
+import heapq
+import bisect
 import math
+import time
+import argparse
+from itertools import repeat, islice, chain
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse
 from tqdm import tqdm
 from nltk import pos_tag
-from nltk.tokenize import RegexpTokenizer
-from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 from datasets import load_dataset
+from analysis import Analyzer, init_worker, analyze_in_worker
+from cache import LRUCache, TinyLFUCache
+from instrument import Stats, NULL_STATS
+from boolean import parse_query, contains_sorted
+import metrics
+from compression import codecs, encode_postings, encode_postings_batch, encode_positions, postings_blocks
+from segment import Segment, SegmentWriter, TieredMergePolicy
+from spimi import SpimiInverter
 import code
 # commented out the import and download of the stopwords and word net as these only needed to be run once
 # import nltk
 # nltk.download('wordnet')
 # nltk.download('stopwords')
 
+# query evaluation methods of SearchAgent.search: term-at-a-time, WAND, Block-Max WAND and sparse matrix products
+methods = ('taat', 'wand', 'bmw', 'sparse')
+
+# query modes of SearchAgent.query: a bag of words ranked by BM25, or the boolean syntax of boolean.py
+modes = ('ranked', 'boolean')
+
+
+def bm25_tf_weight(tf, doc_length, avgdl, k1, b):
+    # term frequency part of the BM25 formula, works on scalars and on NumPy arrays
+    # every scoring path uses it, or normed_tf_weight with the precomputed length_norm, so that scores
+    # and score upper bounds are computed identically
+    return normed_tf_weight(tf, length_norm(doc_length, avgdl, k1, b), k1)
+
+
+def length_norm(doc_length, avgdl, k1, b):
+    # document length normalization of BM25, fixed for a document until avgdl changes
+    return k1 * ((1 - b) + b * (doc_length / avgdl))
+
+
+def normed_tf_weight(tf, norm, k1):
+    # BM25 tf weight given the length_norm of the document
+    return tf * (k1 + 1) / (tf + norm)
+
+
+def iter_jsonl(path, field='article'):
+    # stream the text field of every record of a JSON lines file
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)[field]
+
+
+def iter_batches(items, size):
+    # group any iterable into lists of at most size items
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 # indexer class
 class Indexer:
-    dbfile = "./ir.idx"  # This is the index file you will create and manager for indexing
+    dbfile = "./ir.idx"  # This is the index directory you will create and manager for indexing, see segment.py
+    block_size = 128     # number of postings in one compressed block, also covered by one block-max score upper bound
+    postings_codec = 'vbyte'    # codec used to compress the postings lists, 'vbyte' or 'bitpack'
+    doc_compression = 'zlib'    # compression of the document store blocks, 'zlib' or 'lzma'
+    positions = False           # store term positions for phrase and window queries, see segment.py
+    num_workers = os.cpu_count() or 1   # number of processes analyzing documents when building the index
+    chunk_size = 256            # number of documents sent to a worker process at a time
+    memory_budget = 256 * 2**20 # bytes of in-memory postings before a sorted run is flushed to disk
+    postings_cache_bytes = 64 * 2**20   # bytes of decoded postings lists kept for frequently queried terms
+    instrument = False          # record per-stage timings and counters of every index update, see instrument.py
+    registry = metrics.registry # metrics registry the index reports to, see metrics.py
+    merge_policy = TieredMergePolicy(merge_factor=10, min_segment_docs=1000)
 
-    def __init__(self):
+    def __init__(self, documents=None, read_only=False):
         # data structures to store and manage elements from the search engine
+        # documents is an optional iterable of raw texts to build the index from when it does not exist yet
+        # read_only opens an existing index only to search it while another process may be updating it,
+        # like the worker processes of query_batch do, the files of unfinished updates are then left alone
 
-        self.tok2idx = {}                       # dictionary for token to id mapping
-        self.idx2tok = {}                       # dictionary for id to token mapping
-        self.postings_lists = {}                # term to postings list mapping
-        self.docs = []                          # list to store document information
-        self.raw_ds = []                        # list to store raw documents from search result
+        self.tok2idx = {}                       # dictionary for token to id mapping, ids are dense and start at 0
+        self.idx2tok = []                       # list for id to token mapping
+        self.doc_lengths = np.zeros(0, dtype=np.int32) # array of document lengths (|D|) indexed by doc id
         self.corpus_stats = { 'avgdl': 0 }      # dictionary for corpus level statistics
+        self.norms = np.zeros(0, dtype=np.float32)  # BM25 length_norm of every doc id, see update_score_tables
+        self.idf = np.zeros(0)                  # BM25 IDF of every term id over the live documents
+        self.global_stats = None                # statistics of a whole sharded index this index is a shard of, see shards.py
         self.stopwords = stopwords.words('english') # list of stopwords from NLTK library of stopwords
+        self.analyzer = Analyzer(self.stopwords)    # tokenizer, stopword filter and cached lemmatizer
+        self.manifest = {}                      # index generation, segment names and counters, see segment.py
+        self.segments = []                      # open segments in doc id order, replaced as a whole on every change
+        self.generation = 0                     # incremented whenever documents are added or deleted
+        self.lock = threading.RLock()           # serializes changes to the manifest and the segment list
+        self.merge_thread = None                # background thread running segment merges
+        self.postings_cache = TinyLFUCache(self.postings_cache_bytes)  # decoded postings shared by all segments
+        self.build_stats = None                 # Stats of the last index update when instrument is set
+        self.histograms = None                  # optional StageHistograms aggregating the Stats of index updates
+        self.register_metrics()
 
-        if os.path.exists(self.dbfile):
-            # if the index file exist, load the data from it
-            self.load_index_data()
-            
-            pass
+        if os.path.isfile(self.dbfile):
+            # the single pickle file written by earlier versions, its format cannot be read any more
+            raise ValueError(f'{self.dbfile} is an index file of an earlier version, delete it so that '
+                             f'the index is rebuilt as a directory')
+        if not os.path.exists(os.path.join(self.dbfile, 'manifest.json')):
+            # if the index does not exist, stream the dataset into a first segment
+            # the manifest is only written once that segment is in place, so a build that fails or is
+            # interrupted leaves no index behind and starts over the next time, see remove_stale_files
+
+            if documents is None:
+                ds = load_dataset("cnn_dailymail", '3.0.0', split="test", streaming=True)
+                documents = (row['article'] for row in ds)
+            os.makedirs(self.dbfile, exist_ok=True)
+            self.manifest = {'generation': 0, 'segments': [], 'next_segment': 0, 'next_doc_id': 0,
+                             'num_terms': 0, 'deletes': {}, 'stopwords': self.stopwords}
+            self.remove_stale_files()
+            open(os.path.join(self.dbfile, 'terms.txt'), 'w').close()
+            open(os.path.join(self.dbfile, 'analysis.json'), 'w').close()
+            self.refresh()
+            self.add_documents(documents)
         else:
-            # if the index file does not exist, load and preprocess the dataset
+            # map the index files
+            self.load_index_data()
+            if not read_only:
+                self.remove_stale_files()
 
-            ds = load_dataset("cnn_dailymail", '3.0.0', split="test")
-            self.raw_ds = ds['article']
-            self.clean_text(self.raw_ds)
-            self.create_postings_lists()
+    def register_metrics(self):
+        # counters updated by index changes, and the index size and cache state read when scraped
+        registry = self.registry
+        self.added_docs_metric = registry.counter('index_documents_added_total', 'Documents added to the index.').labels()
+        self.deleted_docs_metric = registry.counter('index_documents_deleted_total', 'Documents deleted from the index.').labels()
+        self.update_seconds_metric = registry.histogram('index_update_duration_seconds', 'Duration of index updates.',
+                                                        buckets=(0.001, 0.01, 0.1, 1, 10, 60, 600, 3600)).labels()
+        self.merge_seconds_metric = registry.histogram('index_merge_duration_seconds', 'Duration of segment merges.',
+                                                       buckets=(0.01, 0.1, 1, 10, 60, 600, 3600)).labels()
+
+        registry.gauge_callback('index_documents', 'Documents in the index, without deleted documents.',
+                                lambda: self.corpus_stats.get('num_docs', 0))
+        registry.gauge_callback('index_deleted_documents', 'Deleted documents whose postings are not merged away yet.',
+                                lambda: sum(segment.num_deleted for segment in self.segments))
+        registry.gauge_callback('index_terms', 'Terms in the lexicon.', lambda: len(self.idx2tok))
+        registry.gauge_callback('index_segments', 'Segments in the index.', lambda: len(self.segments))
+        registry.gauge_callback('index_generation', 'Index generation.', lambda: self.generation)
+        registry.gauge_callback('index_disk_bytes', 'Size of the index directory in bytes.', self.disk_bytes)
+        cache = self.postings_cache
+        registry.gauge_callback('index_postings_cache_bytes', 'Bytes of decoded postings in the postings cache.',
+                                lambda: cache.bytes)
+        registry.counter_callback('index_postings_cache_requests_total', 'Postings cache lookups.',
+                                  lambda: [({'result': 'hit'}, cache.hits), ({'result': 'miss'}, cache.misses)])
+        registry.counter_callback('index_postings_cache_admissions_total', 'Postings lists offered to the postings cache.',
+                                  lambda: [({'result': 'admitted'}, cache.admitted), ({'result': 'rejected'}, cache.rejected)])
+        registry.counter_callback('index_postings_cache_evictions_total', 'Postings lists evicted from the postings cache.',
+                                  lambda: cache.evicted)
+
+    def disk_bytes(self):
+        # total size of the files in the index directory, files removed by a merge meanwhile are skipped
+        size = 0
+        for root, _, names in os.walk(self.dbfile):
+            for name in names:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass
+        return size
 
     def load_index_data(self):
-        # load the data from the index file using pickle
-        # open the index file in binary read mode 'rb'
-        # use pickle.load to deserialize the data 
-        with open (self.dbfile, 'rb') as f:
-            index_data = pickle.load(f)
-
-        # populate the data structures with the loaded data
-        self.tok2idx = index_data['tok2idx']
-        self.idx2tok = index_data['idx2tok']
-        self.postings_lists = index_data['postings_lists']
-        self.docs = index_data['docs']
-        self.raw_ds = index_data['raw_ds']
-        self.corpus_stats = index_data['corpus_stats']
-        self.stopwords = index_data['stopwords']
+        # read the manifest and the lexicon and open the segments, their files are memory-mapped
+        with open(os.path.join(self.dbfile, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(self.dbfile, 'terms.txt'), encoding='utf-8') as f:
+            self.idx2tok = f.read().split('\n')[:self.manifest['num_terms']]
+        self.tok2idx = {term: term_id for term_id, term in enumerate(self.idx2tok)}
+        self.stopwords = self.manifest['stopwords']
+        self.analyzer = Analyzer.load(os.path.join(self.dbfile, 'analysis.json'), self.stopwords)
+        self.refresh()
+
+    def remove_stale_files(self):
+        # remove what an interrupted build, update or merge left behind: the directories of segments
+        # missing from the manifest, among them the .tmp directory of a segment being written and the
+        # .runs directory of its SPIMI runs
+        segments = set(self.manifest['segments'])
+        for name in os.listdir(self.dbfile):
+            if name.startswith('seg_') and name not in segments:
+                shutil.rmtree(os.path.join(self.dbfile, name), ignore_errors=True)
 
     def save_index_data(self):
-        # create a dictionary to hold the index data
-        index_data = {
-            'tok2idx': self.tok2idx,
-            'idx2tok': self.idx2tok,
-            'postings_lists': self.postings_lists,
-            'docs': self.docs,
-            'raw_ds': self.raw_ds,
-            'corpus_stats': self.corpus_stats,
-            'stopwords': self.stopwords
+        # write the manifest atomically, it is the only file that changes in place
+        tmp_path = os.path.join(self.dbfile, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.dbfile, 'manifest.json'))
+
+    def refresh(self):
+        # open the segments listed in the manifest, reusing the ones that are already open,
+        # and recompute the corpus statistics over all of them
+        # deleted documents are left out of the statistics here, their postings are only
+        # discounted from the document frequencies when a term is looked up
+        with self.lock:
+            opened = {segment.name: segment for segment in self.segments}
+            deletes = self.manifest.get('deletes', {})
+            segments = [(opened.get(name) or Segment(os.path.join(self.dbfile, name), self.postings_cache))
+                        .with_deletes(deletes.get(name, 0)) for name in self.manifest['segments']]
+
+            # document lengths indexed by global doc id
+            doc_lengths = np.zeros(self.manifest['next_doc_id'], dtype=np.int32)
+            for segment in segments:
+                doc_lengths[segment.doc_ids] = segment.doc_lengths
+
+            num_docs = sum(segment.num_live_docs for segment in segments)
+            total_length = sum(segment.live_length for segment in segments)
+            if self.global_stats is not None:
+                num_docs, total_length = self.global_stats['num_docs'], self.global_stats['total_length']
+            self.corpus_stats = {
+                'num_docs': num_docs,
+                'total_length': total_length,
+                'avgdl': total_length / num_docs if num_docs else 0
+            }
+            self.doc_lengths = doc_lengths
+            self.segments = segments
+            self.segment_starts = np.array([segment.doc_ids[0] for segment in segments], dtype=np.int64)
+            self.generation = self.manifest['generation']
+            self.update_score_tables()
+
+    def update_score_tables(self):
+        # the parts of BM25 that only change with the index: a float32 length_norm per doc id and the
+        # IDF per term id, so that queries look them up instead of recomputing them
+        # they are saved in norms_<generation>.npy and idf_<generation>.npy along with the BM25 parameters
+        # they were computed for in tables_<generation>.json, and rebuilt when any of these changed
+        # every generation writes files of its own: renaming onto an existing file makes the file system
+        # flush it first, which took longer than building a small segment
+        # the tables of a shard depend on the other shards too, they are only kept in memory
+        k1, b = SearchAgent.k1, SearchAgent.b
+        key = {'generation': self.generation, 'k1': k1, 'b': b,
+               'num_docs': len(self.doc_lengths), 'num_terms': self.manifest['num_terms']}
+        suffix = f'_{self.generation:06d}'
+        tables_path = os.path.join(self.dbfile, f'tables{suffix}.json')
+        if self.global_stats is None:
+            try:
+                with open(tables_path) as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                stored = None
+            if stored == key:
+                self.norms = np.load(os.path.join(self.dbfile, f'norms{suffix}.npy'), mmap_mode='r')
+                self.idf = np.load(os.path.join(self.dbfile, f'idf{suffix}.npy'), mmap_mode='r')
+                return
+
+        norms = length_norm(self.doc_lengths, self.corpus_stats['avgdl'] or 1.0, k1, b).astype(np.float32)
+        doc_freqs = self.live_doc_freqs()
+        if self.global_stats is not None:
+            # document frequencies over all shards, terms added since the last global statistics pass
+            # keep the ones of this shard until the next pass
+            global_doc_freqs = self.global_stats['doc_freqs'][:len(doc_freqs)]
+            doc_freqs[:len(global_doc_freqs)] = global_doc_freqs
+        num_docs = self.corpus_stats['num_docs']
+        idf = np.log((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5) + 1.0)
+
+        if self.global_stats is None:
+            for name, table in (('norms', norms), ('idf', idf)):
+                tmp_path = os.path.join(self.dbfile, f'{name}.tmp.npy')
+                np.save(tmp_path, table)
+                os.replace(tmp_path, os.path.join(self.dbfile, f'{name}{suffix}.npy'))
+            with open(tables_path + '.tmp', 'w') as f:
+                json.dump(key, f)
+            os.replace(tables_path + '.tmp', tables_path)
+            # the tables of earlier generations are not needed anymore
+            for filename in os.listdir(self.dbfile):
+                if filename.startswith(('norms_', 'idf_', 'tables_')) and not filename.startswith(('norms' + suffix, 'idf' + suffix, 'tables' + suffix)):
+                    os.remove(os.path.join(self.dbfile, filename))
+        self.norms, self.idf = norms, idf
+
+    def live_doc_freqs(self):
+        # number of live documents holding every term id
+        doc_freqs = np.zeros(self.manifest['num_terms'], dtype=np.int64)
+        for segment in self.segments:
+            doc_freqs[segment.term_ids] += segment.live_doc_freq_table()
+        return doc_freqs
+
+    def local_stats(self):
+        # statistics of the live documents of this index alone, collected from every shard of a sharded
+        # index by its global statistics pass, see shards.py
+        with self.lock:
+            return {
+                'num_docs': sum(segment.num_live_docs for segment in self.segments),
+                'total_length': sum(segment.live_length for segment in self.segments),
+                'next_doc_id': self.manifest['next_doc_id'],
+                'terms': self.idx2tok[:self.manifest['num_terms']],
+                'doc_freqs': self.live_doc_freqs()
+            }
+
+    def set_global_stats(self, global_stats):
+        # score with the statistics of a whole sharded index instead of those of this index alone:
+        # num_docs, total_length and the doc_freqs of every term id of this index over all shards
+        # None goes back to the statistics of this index
+        with self.lock:
+            self.global_stats = global_stats
+            self.refresh()
+
+    def segment_meta(self, bound_avgdl):
+        # create a dictionary to hold the settings of a new segment
+        return {
+            'postings_codec': self.postings_codec,
+            'block_size': self.block_size,
+            'doc_compression': self.doc_compression,
+            'bound_avgdl': bound_avgdl
         }
 
-        # serialize and save index data to the index file using pickle
-        with open(self.dbfile, 'wb') as f:
-            pickle.dump(index_data, f)
-            
+    def add_documents(self, documents):
+        # index an iterable of raw texts into a new segment and return their doc ids
+        return self.update_documents((), documents)
 
-    def clean_text(self, lst_text, query=False):
-        # Initialize tokenizer and lemmatizer
-        tokenizer = RegexpTokenizer(r'\w+')
-        lemmatizer = WordNetLemmatizer()
+    def delete_documents(self, doc_ids):
+        # mark documents as deleted, their postings stay in place until the segment is merged
+        self.update_documents(doc_ids, ())
 
-        # Initialize a list for the cleaned text
-        cleaned_text = [] 
+    def update_documents(self, doc_ids, documents):
+        # replace documents: the new texts are indexed into a new segment under new doc ids and the old
+        # doc ids are marked deleted, both changes become visible together with the next manifest
+        # returns the doc ids of the new texts, unknown or already deleted doc ids raise KeyError
+        stats = Stats() if self.instrument else NULL_STATS
+        start = time.perf_counter()
+        with self.lock:
+            # find the documents to delete before changing anything
+            deletes = defaultdict(list)
+            for doc_id in doc_ids:
+                segment, local_id = self.locate(doc_id)
+                deletes[segment.name].append(local_id)
+            stats.count('deleted_docs', len(doc_ids))
+
+            name = f"seg_{self.manifest['next_segment']:06d}"
+            first_doc_id = self.manifest['next_doc_id']
+            num_added = self.build_segment(os.path.join(self.dbfile, name), documents, first_doc_id, stats)
+            t = stats.clock()
+
+            # append the new terms to the lexicon before the manifest makes them visible
+            num_terms = self.manifest['num_terms']
+            if len(self.idx2tok) > num_terms:
+                with open(os.path.join(self.dbfile, 'terms.txt'), 'a', encoding='utf-8') as f:
+                    f.write(''.join('\n' + term if term_id else term
+                                    for term_id, term in enumerate(self.idx2tok[num_terms:], num_terms)))
+            self.analyzer.save(os.path.join(self.dbfile, 'analysis.json'))
+
+            # write a new deletes generation for every segment that lost documents
+            generation = self.manifest['generation'] + 1
+            segment_deletes = dict(self.manifest.get('deletes', {}))
+            replaced = []
+            for segment in self.segments:
+                if segment.name in deletes:
+                    deleted = np.zeros(segment.num_docs, dtype=bool) if segment.deleted is None else segment.deleted.copy()
+                    deleted[deletes[segment.name]] = True
+                    segment.write_deletes(deleted, generation)
+                    segment_deletes[segment.name] = generation
+                    replaced.append((segment, segment.deletes_generation))
+
+            self.manifest = dict(self.manifest,
+                                 generation=generation,
+                                 segments=self.manifest['segments'] + ([name] if num_added else []),
+                                 next_segment=self.manifest['next_segment'] + 1,
+                                 next_doc_id=first_doc_id + num_added,
+                                 num_terms=len(self.idx2tok),
+                                 deletes=segment_deletes)
+            self.save_index_data()
+            if not num_added:
+                shutil.rmtree(os.path.join(self.dbfile, name))
+            for segment, deletes_generation in replaced:
+                segment.remove_deletes(deletes_generation)
+            self.refresh()
+            stats.lap('commit', t)
+
+        self.added_docs_metric.inc(num_added)
+        self.deleted_docs_metric.inc(len(doc_ids))
+        self.update_seconds_metric.observe(time.perf_counter() - start)
+
+        if stats.enabled:
+            self.build_stats = stats
+            if self.histograms is not None:
+                self.histograms.record(stats)
+        self.maybe_merge()
+        return list(range(first_doc_id, first_doc_id + num_added))
+
+    def build_segment(self, path, documents, first_doc_id, stats=NULL_STATS):
+        # single-pass in-memory indexing (SPIMI) with bounded memory:
+        # documents are analyzed and written to the segment as they stream in, their postings are
+        # collected until memory_budget is reached and flushed as sorted runs, and the runs are
+        # merged into the final postings lists once all documents are seen
+        writer = SegmentWriter(path, self.doc_compression, self.positions)
+        inverter = SpimiInverter(path + '.runs', self.memory_budget, self.positions)
+        num_terms = len(self.idx2tok)
+
+        try:
+            local_id = 0
+            t = stats.clock()
+            for batch, analyzed in self.analyze_batches(documents):
+                t = stats.lap('analysis', t)
+                for document, lemmatized_tokens in zip(batch, analyzed):
+                    term_ids = self.encode_terms(lemmatized_tokens)
+                    writer.add_document(first_doc_id + local_id, document, term_ids)
+                    inverter.add(local_id, term_ids)
+                    local_id += 1
+                t = stats.lap('inversion', t)
+            self.idx2tok.extend(list(self.tok2idx)[len(self.idx2tok):])  # ids are assigned in insertion order
+
+            # score bounds use the average document length (avgdl) of the index including the new documents
+            doc_lengths = np.array(writer.doc_lengths, dtype=np.int32)
+            total_length = self.corpus_stats.get('total_length', 0) + int(doc_lengths.sum())
+            num_docs = self.corpus_stats.get('num_docs', 0) + len(doc_lengths)
+            avgdl = total_length / num_docs if num_docs else 1.0
+
+            # Compress each merged postings list as d-gaps and term frequencies in blocks, see compression.py,
+            # and store the score upper bounds used for dynamic pruning (WAND / BMW)
+            # the lists are encoded in groups, each in one vectorized pass, since most of them are short
+            codec = codecs[self.postings_codec]
+            num_postings = 0
+            progress = tqdm(desc='merging', unit='term', disable=local_id < self.chunk_size)
+            for term_ids, counts, doc_ids, tfs, positions in inverter.merged_groups():
+                max_scores, block_max_scores, num_blocks = self.score_bounds_batch(doc_lengths[doc_ids], tfs, counts, avgdl)
+                data, sizes = encode_postings_batch(doc_ids, tfs, counts, codec, self.block_size)
+                if positions is not None:
+                    ends = np.cumsum(counts)
+                    positions = [section for term_positions, start, end in zip(positions, ends - counts, ends)
+                                 for section in encode_positions(term_positions, tfs[start:end], self.block_size)]
+                writer.add_postings_batch(term_ids, data, sizes, counts, max_scores, block_max_scores, num_blocks, positions)
+                num_postings += len(doc_ids)
+                progress.update(len(term_ids))
+            progress.close()
+            t = stats.lap('encoding', t)
+
+            writer.finish(self.segment_meta(avgdl))
+            stats.lap('writing', t)
+            stats.count('docs', local_id)
+            stats.count('tokens', int(doc_lengths.sum()))
+            stats.count('new_terms', len(self.idx2tok) - num_terms)
+            stats.count('postings', num_postings)
+            stats.count('runs', len(inverter.runs))
+        finally:
+            inverter.close()
+        return local_id
+
+    def maybe_merge(self, background=True):
+        # start merging segments according to the merge policy, in a background thread by default
+        with self.lock:
+            if self.merge_thread is not None:
+                return
+            if self.find_merge() is None:
+                return
+            self.merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+        if background:
+            self.merge_thread.start()
+        else:
+            self._merge_loop()
+
+    def find_merge(self):
+        # window of segments the merge policy wants merged next, None if there is none
+        return self.merge_policy.find_merge([segment.num_docs for segment in self.segments],
+                                            [segment.num_deleted for segment in self.segments])
+
+    def wait_for_merges(self):
+        # block until the background merges are done
+        thread = self.merge_thread
+        if thread is not None and thread.ident is not None:
+            thread.join()
+
+    def _merge_loop(self):
+        # merge windows of segments until the merge policy is satisfied
+        while True:
+            with self.lock:
+                window = self.find_merge()
+                if window is None:
+                    self.merge_thread = None
+                    return
+                segments = self.segments[window[0]:window[1]]
+                name = f"seg_{self.manifest['next_segment']:06d}"
+                self.manifest = dict(self.manifest, next_segment=self.manifest['next_segment'] + 1)
+            start = time.perf_counter()
+            self.merge_segments(segments, name)
+            self.merge_seconds_metric.observe(time.perf_counter() - start)
+
+    def merge_segments(self, segments, name):
+        # write the live documents and postings of adjacent segments into one new segment and swap it in
+        # deleted documents and their postings are dropped, the others keep their global doc ids
+        path = os.path.join(self.dbfile, name)
+        avgdl = self.corpus_stats['avgdl'] or 1.0
+
+        # local ids of the live documents in the merged segment
+        remaps = []
+        num_docs = 0
+        for segment in segments:
+            live = np.ones(segment.num_docs, dtype=bool) if segment.deleted is None else ~segment.deleted
+            remaps.append(np.cumsum(live) - 1 + num_docs)
+            num_docs += int(live.sum())
 
-        for text in lst_text:
-            tokens = tokenizer.tokenize(text.lower())  # Tokenize and lowercase
+        if num_docs:
+            # positions are kept only if every merged segment has them
+            positions = self.positions and all(segment.has_positions for segment in segments)
+            writer = SegmentWriter(path, self.doc_compression, positions)
+            for segment in segments:
+                for local_id in range(segment.num_docs):
+                    if not segment.is_deleted(local_id):
+                        writer.add_document(int(segment.doc_ids[local_id]), segment.document(local_id),
+                                            segment.doc_terms(local_id))
+            doc_lengths = np.array(writer.doc_lengths, dtype=np.int32)
 
-            if not query:
-                # Remove stopwords for indexing (not for query)
-                tokens = [token for token in tokens if token not in self.stopwords]
+            codec = codecs[self.postings_codec]
+            term_ids = np.unique(np.concatenate([segment.term_ids for segment in segments]))
+            for term_id in term_ids.tolist():
+                parts = []
+                for segment, remap in zip(segments, remaps):
+                    local_ids, tfs = segment.live_postings(term_id)
+                    if len(local_ids):
+                        term_positions = segment.term_positions(term_id, local_ids)[1] if positions else None
+                        parts.append((remap[local_ids], tfs, term_positions))
+                if not parts:
+                    continue
+                doc_ids = np.concatenate([part[0] for part in parts])
+                tfs = np.concatenate([part[1] for part in parts])
+                max_score, block_max_scores = self.score_bounds(doc_lengths[doc_ids], tfs, avgdl)
+                term_positions = None
+                if positions:
+                    term_positions = encode_positions(np.concatenate([part[2] for part in parts]), tfs, self.block_size)
+                writer.add_postings(term_id, encode_postings(doc_ids, tfs, codec, self.block_size),
+                                    len(doc_ids), max_score, block_max_scores, term_positions)
+            writer.finish(self.segment_meta(avgdl))
 
-            lemmatized_tokens = []
-            for token in tokens:
-                lemmatized_tokens.append(lemmatizer.lemmatize(token))  # Lemmatize
+        # replace the merged segments by the new one, results do not change so the generation stays
+        merged = [segment.name for segment in segments]
+        with self.lock:
+            segment_deletes = {segment: generation for segment, generation in self.manifest.get('deletes', {}).items()
+                               if segment not in merged}
 
-            # Join the tokens back into a single string
-            cleaned_text.append(" ".join(lemmatized_tokens))
+            # documents deleted while the merge was running are deleted in the merged segment as well
+            current = {segment.name: segment for segment in self.segments}
+            deleted = np.zeros(num_docs, dtype=bool)
+            for segment, remap in zip(segments, remaps):
+                latest = current[segment.name]
+                if latest.deletes_generation != segment.deletes_generation:
+                    newly_deleted = latest.deleted if segment.deleted is None else latest.deleted & ~segment.deleted
+                    deleted[remap[newly_deleted]] = True
+            if deleted.any():
+                Segment(path).write_deletes(deleted, self.manifest['generation'])
+                segment_deletes[name] = self.manifest['generation']
 
-        if not query:
-            self.docs = cleaned_text  # Assign the cleaned text to self.docs for indexing
+            names = self.manifest['segments']
+            start = names.index(merged[0])
+            self.manifest = dict(self.manifest,
+                                 segments=names[:start] + ([name] if num_docs else []) + names[start + len(merged):],
+                                 deletes=segment_deletes)
+            self.save_index_data()
+            self.refresh()
+        for segment in merged:
+            shutil.rmtree(os.path.join(self.dbfile, segment), ignore_errors=True)
+
+    def analyze_batches(self, documents):
+        # analyze a stream of documents in batches of chunk_size, yielding (batch, analyzed batch)
+        # in the original order; with several workers at most two batches per worker are in flight
+        # so the stream is never materialized
+        # every worker gets a copy of the analyzer once and sends back the cache entries it adds
+        analyzer = self.analyzer
+        batches = iter_batches(documents, self.chunk_size)
+        first_batches = list(islice(batches, 2))
+        if len(first_batches) < 2:
+            # a single chunk, e.g. a small add_documents: analyzed here without a progress bar or worker processes
+            for batch in first_batches:
+                yield batch, analyzer.analyze_batch(batch)
+            return
+
+        batches = chain(first_batches, batches)
+        progress = tqdm(desc='analyzing', unit='doc')
+        try:
+            if self.num_workers <= 1:
+                for batch in batches:
+                    yield batch, analyzer.analyze_batch(batch)
+                    progress.update(len(batch))
+                return
+
+            with ProcessPoolExecutor(self.num_workers, initializer=init_worker, initargs=(analyzer,)) as executor:
+                pending = deque()
+                for batch in batches:
+                    pending.append((batch, executor.submit(analyze_in_worker, batch)))
+                    if len(pending) >= 2 * self.num_workers:
+                        batch, future = pending.popleft()
+                        analyzed, new_terms = future.result()
+                        analyzer.update(new_terms)
+                        yield batch, analyzed
+                        progress.update(len(batch))
+                while pending:
+                    batch, future = pending.popleft()
+                    analyzed, new_terms = future.result()
+                    analyzer.update(new_terms)
+                    yield batch, analyzed
+                    progress.update(len(batch))
+        finally:
+            progress.close()
+
+    def encode_terms(self, lemmatized_tokens):
+        # Encode a document as an array of term ids, new terms get the next free id
+        term_ids = [self.tok2idx.setdefault(token, len(self.tok2idx)) for token in lemmatized_tokens]
+        return np.array(term_ids, dtype=np.int32)
+
+    def clean_text(self, lst_text, query=False):
+        # Initialize a list for the cleaned text
+        cleaned_text = []
+
+        if query:
+            analyzed_batches = [self.analyzer.analyze_batch(lst_text, query=True)]
+        else:
+            # documents are analyzed by the worker processes like when building the index
+            analyzed_batches = (analyzed for _, analyzed in self.analyze_batches(lst_text))
+
+        for analyzed in analyzed_batches:
+            for lemmatized_tokens in analyzed:
+                # Join the tokens back into a single string
+                cleaned_text.append(" ".join(lemmatized_tokens))
 
         return cleaned_text
 
-    def create_postings_lists(self):
-        # Initialize data structures for postings and document statistics
-        self.postings_lists = defaultdict(list)
-        doc_lengths = []
-        df = defaultdict(int)
-
-        for doc_id, doc_text in enumerate(self.docs):
-            # Tokenize the document
-            tokens = doc_text.split()
-
-            # Update document length
-            doc_length = len(tokens)
-            doc_lengths.append(doc_length)
-
-            # Compute document frequencies (df)
-            unique_tokens = set(tokens)
-            for token in unique_tokens:  # Use unique tokens to count each term only once per document
-                df[token] += 1
-
-            # Create postings list
-            for token in unique_tokens:  # Use unique tokens to create postings list
-                self.postings_lists[token].append(doc_id)
-
-        # Compute the average document length (avgdl)
-        total_doc_length = sum(doc_lengths)
-        num_docs = len(self.docs)
-        avgdl = total_doc_length / num_docs
-        self.corpus_stats['avgdl'] = avgdl
-
-        # Create an index data dictionary to store postings lists, document frequencies, and avgdl
-        index_data = {
-            'postings_lists': dict(self.postings_lists),
-            'document_frequencies': dict(df),
-            'avgdl': avgdl
-        }
+    def score_bounds(self, doc_lengths, tfs, avgdl):
+        # upper bounds of the BM25 tf weight over a whole postings list and over each block of it
+        max_scores, block_max, _ = self.score_bounds_batch(doc_lengths, tfs, [len(tfs)], avgdl)
+        return float(max_scores[0]), block_max
+
+    def score_bounds_batch(self, doc_lengths, tfs, counts, avgdl):
+        # score_bounds() of postings lists given back to back, counts[i] postings each:
+        # (upper bound of every list, upper bounds of all blocks back to back, number of blocks of every list)
+        # the bounds use the BM25 parameters of SearchAgent, the query time IDF weight is applied on top
+        k1, b = SearchAgent.k1, SearchAgent.b
+        num_blocks, block_starts = postings_blocks(counts, self.block_size)
+        tf_weights = bm25_tf_weight(tfs, doc_lengths, avgdl, k1, b)
+        block_max = np.maximum.reduceat(tf_weights, block_starts)
+        max_scores = np.maximum.reduceat(block_max, np.cumsum(num_blocks) - num_blocks)
+        return max_scores, block_max, num_blocks
+
+    def doc_freq(self, term_id):
+        # document frequency of a term over all segments, without deleted documents
+        return sum(segment.live_doc_freq(term_id) for segment in self.segments)
+
+    def get_postings(self, term_id):
+        # return the decoded (global doc ids, term frequencies) arrays of a term over all segments
+        # postings of deleted documents are left out
+        doc_ids, tfs = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int32)]
+        for segment in self.segments:
+            local_ids, segment_tfs = segment.live_postings(term_id)
+            if len(local_ids):
+                doc_ids.append(segment.doc_ids[local_ids])
+                tfs.append(segment_tfs)
+        return np.concatenate(doc_ids), np.concatenate(tfs)
+
+    def locate(self, doc_id):
+        # (segment, local id) of a global doc id, deleted documents raise KeyError like unknown ones
+        segments = self.segments
+        position = int(np.searchsorted(self.segment_starts, doc_id, side='right')) - 1
+        local_id = segments[position].local_id(doc_id) if position >= 0 else None
+        if local_id is None:
+            raise KeyError(f'unknown doc id: {doc_id}')
+        return segments[position], local_id
+
+    def get_doc_terms(self, doc_id):
+        # term id array of a document from the forward index
+        segment, local_id = self.locate(doc_id)
+        return segment.doc_terms(local_id)
+
+    def get_document(self, doc_id):
+        # raw text of a document, read from the index on demand
+        segment, local_id = self.locate(doc_id)
+        return segment.document(local_id)
+
+
+class PostingsCursor:
+    # cursor over one compressed postings list for document-at-a-time query evaluation
+    # blocks are decoded only when the cursor lands in them, skipped blocks are never decoded
+    end = np.iinfo(np.int32).max    # doc id of an exhausted cursor
+
+    def __init__(self, postings, weight, max_score, block_max_scores):
+        self.postings = postings
+        self.weight = weight                                # query term weight, qtf * idf
+        self.max_score = weight * max_score                 # upper bound of the term score over the whole list
+        self.block_max_scores = weight * block_max_scores   # upper bounds of the term score per block
+        self.block_last_docs = postings.block_last_docs     # last doc id of every block, from the skip table
+        self.block = -1
+        self.decoded = 0                                    # number of postings decoded so far
+        self._load_block(0)
+
+    def _load_block(self, block):
+        # decode a block and move to its first posting
+        self.block = block
+        if block >= self.postings.num_blocks:
+            self.doc = self.end
+            return
+        doc_ids, tfs = self.postings.block(block)
+        self.doc_ids = doc_ids.tolist()
+        self.tfs = tfs.tolist()
+        self.decoded += len(self.doc_ids)
+        self.pos = 0
+        self.doc = self.doc_ids[0]
+
+    def next(self):
+        # move to the next posting
+        self.pos += 1
+        if self.pos == len(self.doc_ids):
+            self._load_block(self.block + 1)
+        else:
+            self.doc = self.doc_ids[self.pos]
+
+    def next_geq(self, target):
+        # move to the first posting with doc id >= target, jumping over whole blocks with the skip table
+        if self.doc >= target:
+            return
+        block = int(np.searchsorted(self.block_last_docs, target))
+        if block != self.block:
+            self._load_block(block)
+            if self.doc == self.end:
+                return
+        self.pos = bisect.bisect_left(self.doc_ids, target, self.pos)
+        self.doc = self.doc_ids[self.pos]
+
+    def tf(self):
+        return self.tfs[self.pos]
+
+    def block_bound(self, target):
+        # (score upper bound, last doc id) of the block that would hold target
+        block = int(np.searchsorted(self.block_last_docs, target))
+        if block == len(self.block_last_docs):
+            return 0.0, self.end
+        return self.block_max_scores[block], int(self.block_last_docs[block])
+
+
+class RankedList:
+    # top-k results of a query, selected from the scored candidates only when first accessed
+    # candidates past depth k are never sorted and no (doc id, score) tuples are built for them
+
+    def __init__(self, doc_ids, scores, k, stats=None):
+        self.candidate_ids = doc_ids
+        self.candidate_scores = scores
+        self.k = max(k, 0)
+        self.order = None   # indices of the ranked candidates, filled in by _rank()
+        self.stats = stats  # Stats of the query when the search agent is instrumented
+
+    def _rank(self):
+        if self.order is not None:
+            return self.order
+        scores = self.candidate_scores
+        if len(scores) > self.k:
+            if self.k == 0:
+                self.order = np.zeros(0, dtype=np.int64)
+                return self.order
+            # select the candidates scoring at least the k-th best score in linear time, keeping all
+            # documents tied with the k-th score so that ties are broken by doc id like a full sort
+            kth_score = scores[np.argpartition(-scores, self.k - 1)[self.k - 1]]
+            selected = np.flatnonzero(scores >= kth_score)
+        else:
+            selected = np.arange(len(scores))
+        # sort the selected candidates by score descending, then doc id ascending
+        ranked = selected[np.lexsort((self.candidate_ids[selected], -scores[selected]))]
+        self.order = ranked[:self.k]
+        return self.order
+
+    def __len__(self):
+        return min(self.k, len(self.candidate_ids))
+
+    def __getitem__(self, i):
+        order = self._rank()
+        if isinstance(i, slice):
+            return [(int(self.candidate_ids[j]), float(self.candidate_scores[j])) for j in order[i]]
+        j = order[i]
+        return int(self.candidate_ids[j]), float(self.candidate_scores[j])
+
+    def __iter__(self):
+        for j in self._rank():
+            yield int(self.candidate_ids[j]), float(self.candidate_scores[j])
+
+    def doc_ids(self):
+        # ranked doc ids as an array, without building tuples
+        return self.candidate_ids[self._rank()]
+
+    def __repr__(self):
+        return f'RankedList({self[:]!r})'
+
+    def top(self):
+        # a RankedList holding only the ranked top-k, without the other candidates
+        order = self._rank()
+        return RankedList(self.candidate_ids[order], self.candidate_scores[order], self.k)
+
+    def with_stats(self, stats):
+        # the same ranked list carrying the Stats of one query, cached lists are shared so they are not changed
+        results = RankedList(self.candidate_ids, self.candidate_scores, self.k, stats)
+        results.order = self.order
+        return results
+
+    def __reduce__(self):
+        # pickle only the ranked top-k, e.g. when results come back from a worker process
+        top = self.top()
+        return RankedList, (top.candidate_ids, top.candidate_scores, top.k)
+
+
+class BatchResults(list):
+    # ranked lists of a batch of queries in query order, with the throughput of the batch
+
+    def __init__(self, results, elapsed):
+        super().__init__(results)
+        self.elapsed = elapsed      # seconds from the query strings to the last ranked list
+        self.qps = len(results) / elapsed if elapsed > 0 else float('inf')
+
+    def __repr__(self):
+        return f'BatchResults({len(self)} queries, {self.elapsed:.3f} s, {self.qps:.1f} queries/s)'
+
+
+class ScoreMatrix:
+    # term x document CSR matrix of the BM25 tf weight of every live posting for one index generation,
+    # so that the scores of a query are one sparse vector x matrix product and those of a batch of
+    # queries one sparse matrix x matrix product
+    # it is built from the forward index of every segment: the (term id, doc id) pair of every token
+    # summed into term frequencies, then weighted with the length norms and IDF of the generation
+
+    def __init__(self, indexer, k1):
+        with indexer.lock:
+            # a consistent view of the index, it is not changed in place by later updates
+            generation, segments = indexer.generation, indexer.segments
+            norms, idf = indexer.norms, indexer.idf
+        self.generation = generation
+        self.num_terms = num_terms = len(idf)
+        self.idf = idf
+
+        term_ids, doc_ids = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)]
+        for segment in segments:
+            tokens_doc_ids = np.repeat(segment.doc_ids, segment.doc_lengths)
+            tokens_term_ids = segment.forward_data
+            if segment.deleted is not None:
+                live = np.repeat(~segment.deleted, segment.doc_lengths)
+                tokens_doc_ids, tokens_term_ids = tokens_doc_ids[live], tokens_term_ids[live]
+            term_ids.append(tokens_term_ids)
+            doc_ids.append(tokens_doc_ids)
+        term_ids, doc_ids = np.concatenate(term_ids), np.concatenate(doc_ids)
+
+        # duplicate (term, doc) entries are summed into the term frequencies
+        weights = scipy.sparse.csr_matrix((np.ones(len(term_ids)), (term_ids, doc_ids)),
+                                          shape=(num_terms, len(norms)))
+        weights.sum_duplicates()
+        weights.data = normed_tf_weight(weights.data, norms[weights.indices], k1)
+        self.weights = weights
+
+    def query_vectors(self, batch_terms):
+        # CSR matrix with one row of qtf * IDF weights per query, from lists of (term id, qtf)
+        # the terms keep their order in the rows, which is the order their weights are summed in
+        indptr, cols, values = [0], [], []
+        for query_terms in batch_terms:
+            for term_id, qtf in query_terms:
+                # terms added after the matrix was built have no postings in it
+                if term_id < self.num_terms:
+                    cols.append(term_id)
+                    values.append(qtf * self.idf[term_id])
+            indptr.append(len(cols))
+        return scipy.sparse.csr_matrix((np.array(values, dtype=np.float64), np.array(cols, dtype=np.int32), indptr),
+                                       shape=(len(batch_terms), self.num_terms))
+
+    def scores(self, batch_terms):
+        # (doc ids, BM25 scores) of the documents holding a query term, for every query of a batch
+        products = self.query_vectors(batch_terms) @ self.weights
+        indptr = products.indptr
+        return [(products.indices[start:end], products.data[start:end])
+                for start, end in zip(indptr[:-1], indptr[1:])]
 
 
 class SearchAgent:
     k1 = 1.5                # BM25 parameter k1 for tf saturation
     b = 0.75                # BM25 parameter b for document length normalization
+    batch_size = 64         # number of queries of a batch that share their decoded postings
+    result_cache_size = 1024    # number of ranked lists kept in the result cache
+    instrument = False          # record per-stage timings and counters of every query, see instrument.py
+    registry = metrics.registry # metrics registry the search agent reports to, see metrics.py
 
     def __init__(self, indexer):
         
         self.indexer = indexer
+        self.local = threading.local()  # per-thread state, the score accumulator of each thread
+        self.result_cache = LRUCache(self.result_cache_size)    # (query terms, k, method) to ranked list
+        self.result_cache_generation = indexer.generation       # index generation the cached results belong to
+        self.histograms = None      # optional StageHistograms aggregating the Stats of the queries
+        self.matrix = None          # ScoreMatrix of the 'sparse' method, built for the current index generation
+        self.matrix_lock = threading.Lock()
+        self.executor = None        # worker processes of query_batch, see worker_pool
+        self.executor_workers = 0
+        self.executor_lock = threading.Lock()
+        self.register_metrics()
 
-    def query(self, q_str):
+    def register_metrics(self):
+        # query counters and latency histograms per method, and the result cache state read when scraped
+        registry = self.registry
+        queries = registry.counter('search_queries_total', 'Queries ranked.', ['method'])
+        latency = registry.histogram('search_query_duration_seconds', 'Time to rank an analyzed query.', ['method'])
+        self.query_metrics = {method: (queries.labels(method=method), latency.labels(method=method))
+                              for method in methods}
+        cache = self.result_cache
+        registry.counter_callback('search_result_cache_requests_total', 'Result cache lookups.',
+                                  lambda: [({'result': 'hit'}, cache.hits), ({'result': 'miss'}, cache.misses)])
+        registry.gauge_callback('search_result_cache_entries', 'Ranked lists in the result cache.', lambda: len(cache))
+
+    def query(self, q_str, k=10, method='taat', mode='ranked'):
         # process the query using the same clean_text process
-        cleaned_query = self.indexer.clean_text([q_str], query=True)[0]
+        # with mode='boolean' the query is parsed as AND / OR / NOT, parentheses and quoted phrases,
+        # see boolean.py, and method is ignored
+        if mode not in modes:
+            raise ValueError(f'unknown query mode: {mode}')
+        stats = Stats() if self.instrument else NULL_STATS
+        if mode == 'boolean':
+            results = self.search_boolean(q_str, k, stats)
+        else:
+            t = stats.clock()
+            cleaned_query = self.indexer.clean_text([q_str], query=True)[0]
+            stats.lap('analysis', t)
+            results = self.search(cleaned_query, k, method, stats=stats)
 
-        # Calculate BM25 scores for documents
-        results = self.calculate_bm25_scores(cleaned_query)
+        # display results
+        t = stats.clock()
+        self.display_results(results)
+        stats.lap('display', t)
+        self.record(stats)
+        return results
 
-        # Sort the results by scores in descending order
-        sorted_results = sorted(results.items(), key=lambda x: x[1], reverse=True)
+    def phrase_query(self, q_str, k=10, window=None):
+        # like query() for the words of q_str as a phrase, or within a window of `window` terms when set
+        # stopwords are removed like in the documents so that the positions line up with the index
+        stats = Stats() if self.instrument else NULL_STATS
+        t = stats.clock()
+        cleaned_phrase = ' '.join(self.indexer.analyzer.analyze(q_str))
+        stats.lap('analysis', t)
+        results = self.search_phrase(cleaned_phrase, k, window, stats)
 
-        # display results
-        self.display_results(sorted_results)
+        t = stats.clock()
+        self.display_results(results)
+        stats.lap('display', t)
+        self.record(stats)
+        return results
 
-    def calculate_bm25_scores(self, cleaned_query):
-        # Create a dictionary to store document scores
-        results = {}
+    def record(self, stats):
+        # add the Stats of a finished query to the histograms
+        if stats.enabled and self.histograms is not None:
+            self.histograms.record(stats)
 
-        # Calculate IDF (inverse document frequency) for each query term
-        query_terms = cleaned_query.split()
-        idf_values = {}
-        for term in query_terms:
-            df_term = len(self.indexer.postings_lists.get(term, []))
-            idf_term = math.log((len(self.indexer.docs) - df_term + 0.5) / (df_term + 0.5) + 1.0)
-            idf_values[term] = idf_term
+    def search(self, cleaned_query, k=10, method='taat', term_scores=None, stats=None, query_scores=None):
+        # ranked list of the top-k documents of an analyzed query, served from the result cache when
+        # the same query terms were ranked before at the current index generation
+        # stats is filled in by query(), otherwise the search records Stats of its own when instrumented
+        # query_scores optionally holds the (doc ids, scores) of the query from a batch matrix product
+        finished = stats is None
+        if stats is None:
+            stats = Stats() if self.instrument else NULL_STATS
+        start = time.perf_counter()
+        t = stats.clock()
+        generation = self.check_result_cache()
+        key = self.result_key(cleaned_query, k, method)
+        results = self.result_cache.get(key)
+        stats.count('result_cache_misses' if results is None else 'result_cache_hits')
+        t = stats.lap('result_cache', t)
+        if results is None:
+            results = self.rank(cleaned_query, k, method, term_scores, stats, query_scores)
+            t = stats.clock()
+            results = results.top()
+            stats.lap('ranking', t)
+            if self.indexer.generation == generation:
+                self.result_cache.put(key, results)
+
+        queries, latency = self.query_metrics[method]
+        queries.inc()
+        latency.observe(time.perf_counter() - start)
+        if stats.enabled:
+            results = results.with_stats(stats)
+            if finished:
+                self.record(stats)
+        return results
+
+    def check_result_cache(self):
+        # empty the result cache when documents were added or deleted, every cached result may be stale,
+        # and return the index generation the cache now belongs to
+        generation = self.indexer.generation
+        if generation != self.result_cache_generation:
+            self.result_cache.clear()
+            self.result_cache_generation = generation
+        return generation
+
+    def result_key(self, cleaned_query, k, method):
+        # queries with the same multiset of indexed terms have the same results, whatever the term
+        # order or the terms missing from the index
+        return tuple(self.query_terms(cleaned_query)), k, method
+
+    def rank(self, cleaned_query, k=10, method='taat', term_scores=None, stats=NULL_STATS, query_scores=None):
+        # score an analyzed query and return the ranked list of its top-k documents
+        if method not in methods:
+            raise ValueError(f'unknown query method: {method}')
+        if stats.enabled:
+            postings_cache_hits = self.indexer.postings_cache.hits
+
+        if method == 'taat':
+            # Calculate BM25 scores for the documents in the postings of the query terms
+            # and select the top-k of them lazily instead of sorting every scored document
+            doc_ids, scores = self.score_taat(cleaned_query, term_scores, stats)
+            results = RankedList(doc_ids, scores, k)
+        elif method == 'sparse':
+            # query vector x BM25 weight matrix, unless the batch product already scored the query
+            if query_scores is None:
+                t = stats.clock()
+                query_scores = self.score_matrix().scores([self.query_terms(cleaned_query)])[0]
+                stats.lap('scoring', t)
+            doc_ids, scores = query_scores
+            stats.count('docs_scored', len(doc_ids))
+            results = RankedList(doc_ids, scores, k)
+        else:
+            # top-k document-at-a-time evaluation with dynamic pruning, already bounded by a heap of size k
+            top_k = self.score_daat(cleaned_query, k, block_max=(method == 'bmw'), stats=stats)
+            doc_ids = np.array([doc_id for doc_id, _ in top_k], dtype=np.int32)
+            scores = np.array([score for _, score in top_k], dtype=np.float64)
+            results = RankedList(doc_ids, scores, k)
+
+        if stats.enabled:
+            # shared by all threads, so concurrent queries may count each other's hits
+            stats.count('postings_cache_hits', self.indexer.postings_cache.hits - postings_cache_hits)
+        return results
+
+    def query_batch(self, queries, k=10, method='taat', num_workers=1):
+        # rank a list of query strings without displaying them, returns BatchResults holding one
+        # RankedList per query in query order, along with the elapsed time and queries per second
+        # with num_workers > 1 the batch is spread over worker processes that map the same index, they
+        # are started by the first such batch and kept with their caches until close()
+        executor = None
+        if num_workers > 1 and len(queries) > self.batch_size:
+            executor = self.worker_pool(num_workers)
+        start = time.perf_counter()
+        cleaned_queries = self.indexer.clean_text(queries, query=True)
+        chunks = list(iter_batches(cleaned_queries, self.batch_size))
+
+        if executor is not None:
+            generation = self.indexer.generation
+            ranked_chunks = list(executor.map(search_in_worker, chunks, repeat(k), repeat(method), repeat(generation)))
+        else:
+            ranked_chunks = [self.search_batch(chunk, k, method) for chunk in chunks]
+
+        return BatchResults([results for chunk in ranked_chunks for results in chunk], time.perf_counter() - start)
+
+    def worker_pool(self, num_workers):
+        # process pool of query_batch with num_workers workers, started on first use and replaced when
+        # another number of workers is asked for
+        with self.executor_lock:
+            if self.executor is None or self.executor_workers != num_workers:
+                if self.executor is not None:
+                    self.executor.shutdown()
+                self.executor = ProcessPoolExecutor(num_workers, initializer=init_search_worker,
+                                                    initargs=(self.indexer.dbfile,))
+                self.executor_workers = num_workers
+            return self.executor
+
+    def close(self):
+        # stop the worker processes of query_batch
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def search_batch(self, cleaned_queries, k=10, method='taat'):
+        # rank a list of analyzed queries, with term-at-a-time scoring the postings of every distinct
+        # term of the batch are decoded and scored only once, and with the sparse method the queries
+        # missing from the result cache are scored by a single matrix product
+        term_scores = None
+        batch_scores = {}
+        self.check_result_cache()
+        pending = [cleaned_query for cleaned_query in cleaned_queries
+                   if self.result_key(cleaned_query, k, method) not in self.result_cache]
+        if method == 'taat':
+            term_ids = {term_id for cleaned_query in pending for term_id, _ in self.query_terms(cleaned_query)}
+            term_scores = {term_id: self.term_scores(term_id) for term_id in term_ids}
+        elif method == 'sparse' and pending:
+            scores = self.score_matrix().scores([self.query_terms(cleaned_query) for cleaned_query in pending])
+            batch_scores = dict(zip(pending, scores))
+        return [self.search(cleaned_query, k, method, term_scores, query_scores=batch_scores.get(cleaned_query))
+                for cleaned_query in cleaned_queries]
+
+    def score_matrix(self):
+        # ScoreMatrix of the current index generation, rebuilt after documents were added or deleted
+        matrix = self.matrix
+        if matrix is None or matrix.generation != self.indexer.generation:
+            with self.matrix_lock:
+                matrix = self.matrix
+                if matrix is None or matrix.generation != self.indexer.generation:
+                    matrix = self.matrix = ScoreMatrix(self.indexer, self.k1)
+        return matrix
+
+    def cache_stats(self):
+        # hit and miss counters and sizes of the caches used by the search agent
+        return {'results': self.result_cache.stats(), 'postings': self.indexer.postings_cache.stats()}
+
+    def query_terms(self, cleaned_query):
+        # collapse repeated query terms into (term id, query term frequency) pairs, in the order of the
+        # terms themselves so that scores are summed in the same order by indexes with other term ids
+        # (the shards of shards.py)
+        # terms that are not in the index cannot contribute to any score and are dropped
+        # as are terms added by an index update that is not committed yet
+        tok2idx = self.indexer.tok2idx
+        num_terms = len(self.indexer.idf)
+        return [(tok2idx[term], qtf) for term, qtf in sorted(Counter(cleaned_query.split()).items())
+                if tok2idx.get(term, num_terms) < num_terms]
+
+    def term_scores(self, term_id, stats=NULL_STATS):
+        # (doc ids, BM25 scores) of a term for every document in its postings list, for a query term frequency of 1
+        t = stats.clock()
+        doc_ids, tfs = self.indexer.get_postings(term_id)
+        t = stats.lap('postings', t)
+
+        # IDF and length norms are looked up in the tables of the index
+        scores = self.indexer.idf[term_id] * normed_tf_weight(tfs, self.indexer.norms[doc_ids], self.k1)
+        stats.lap('scoring', t)
+        return doc_ids, scores
+
+    def score_taat(self, cleaned_query, term_scores=None, stats=NULL_STATS):
+        # term-at-a-time BM25 scoring: walk the postings of each query term and add the
+        # contributions into the accumulator, so the cost scales with the postings touched
+        # term_scores optionally maps term ids to term_scores() computed once for a batch of queries
+
+        # the accumulator has one float32 slot per document and is reused across the queries of a thread,
+        # it is (re)allocated only when the doc id range changes
+        doc_id_range = len(self.indexer.doc_lengths)
+        acc = getattr(self.local, 'accumulator', None)
+        if acc is None or len(acc) != doc_id_range:
+            acc = self.local.accumulator = np.zeros(doc_id_range, dtype=np.float32)
+
+        touched = []
+        for term_id, qtf in self.query_terms(cleaned_query):
+            # BM25 contribution of the term for every document in its postings list,
+            # weighted by how often the term appears in the query
+            # term_scores only covers the queries missing from the result cache when the batch was planned,
+            # a cached result evicted since then by later queries or another thread is ranked again
+            if term_scores is not None and term_id in term_scores:
+                doc_ids, scores = term_scores[term_id]
+            else:
+                doc_ids, scores = self.term_scores(term_id, stats)
+            t = stats.clock()
+            acc[doc_ids] += qtf * scores
+            touched.append(doc_ids)
+            stats.lap('scoring', t)
+            stats.count('postings_scanned', len(doc_ids))
 
-        # Iterate through documents and calculate scores
-        for doc_id, doc_text in enumerate(self.indexer.docs):
-            doc_score = 0.0
+        if not touched:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
 
-            # Tokenize the document
-            doc_terms = doc_text.split()
+        # collect the scored documents and reset only the touched slots for the next query
+        t = stats.clock()
+        doc_ids = np.unique(np.concatenate(touched))
+        scores = acc[doc_ids]
+        acc[doc_ids] = 0.0
+        stats.lap('scoring', t)
+        stats.count('docs_scored', len(doc_ids))
+        return doc_ids, scores
 
-            # Calculate document length (|D|)
-            doc_length = len(doc_terms)
+    def score_daat(self, cleaned_query, k, block_max=True, stats=NULL_STATS):
+        # document-at-a-time top-k BM25 with WAND, or Block-Max WAND when block_max is set
+        # documents whose score upper bound cannot beat the current k-th best score are skipped,
+        # so the result is the same top-k as exhaustive scoring (ties go to the lower doc id)
+        if k <= 0:
+            return []
 
-            # Calculate average document length (avgdl) from corpus stats
-            avgdl = self.indexer.corpus_stats['avgdl']
+        segments = self.indexer.segments
+        avgdl = self.indexer.corpus_stats['avgdl']
+        norms, idf = self.indexer.norms, self.indexer.idf
+        t = stats.clock()
 
-            for term in query_terms:
-                # Calculate TF (term frequency) for the term in the document
-                tf_term = doc_terms.count(term)
+        # IDF weights use the document frequencies over the whole index
+        weights = [(term_id, qtf * float(idf[term_id])) for term_id, qtf in self.query_terms(cleaned_query)]
+
+        t = stats.lap('idf', t)
+
+        heap = []           # min-heap of (score, -doc_id) holding the current top-k
+        threshold = 0.0     # score a document must beat to enter the top-k
+        docs_scored = 0
+        decoded = 0
+        for segment in segments:
+            # the segments are evaluated one after the other and share the heap, so the threshold
+            # reached in a segment already prunes the next one
+            cursors = []
+            for term_id, weight in weights:
+                postings = segment.postings(term_id)
+                if postings is not None:
+                    max_score, block_max_scores = segment.score_bounds(term_id, avgdl)
+                    cursors.append(PostingsCursor(postings, weight, max_score, block_max_scores))
+            t = stats.lap('postings', t)
+
+            active = list(cursors)
+            while True:
+                active = [c for c in active if c.doc != PostingsCursor.end]
+                active.sort(key=lambda c: c.doc)
+
+                # find the pivot: the first cursor at which the summed upper bounds beat the threshold
+                upper = 0.0
+                pivot = None
+                for i, c in enumerate(active):
+                    upper += c.max_score
+                    if upper > threshold:
+                        pivot = i
+                        break
+                if pivot is None:
+                    break
+                pivot_doc = active[pivot].doc
+                while pivot + 1 < len(active) and active[pivot + 1].doc == pivot_doc:
+                    pivot += 1
+
+                if block_max:
+                    # check the tighter block-max bounds before touching any posting, and if they cannot
+                    # beat the threshold jump past the end of the shallowest block
+                    bounds = [c.block_bound(pivot_doc) for c in active[:pivot + 1]]
+                    if sum(bound for bound, _ in bounds) <= threshold:
+                        next_doc = min(last for _, last in bounds) + 1
+                        if pivot + 1 < len(active):
+                            next_doc = min(next_doc, active[pivot + 1].doc)
+                        for c in active[:pivot + 1]:
+                            c.next_geq(next_doc)
+                        continue
+
+                if active[0].doc == pivot_doc and segment.is_deleted(pivot_doc):
+                    # deleted documents are still in the postings, step over them without scoring
+                    for c in active[:pivot + 1]:
+                        c.next()
+                elif active[0].doc == pivot_doc:
+                    # all cursors up to the pivot are on the pivot document: score it fully
+                    doc_id = int(segment.doc_ids[pivot_doc])
+                    norm = float(norms[doc_id])
+                    score = 0.0
+                    for c in cursors:
+                        if c.doc == pivot_doc:
+                            score += c.weight * normed_tf_weight(c.tf(), norm, self.k1)
+                    docs_scored += 1
+                    entry = (score, -doc_id)
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                    if len(heap) == k:
+                        # small margin so that rounding in the summed bounds never prunes a true top-k document
+                        threshold = heap[0][0] * (1 - 1e-12)
+                    for c in active[:pivot + 1]:
+                        c.next()
+                else:
+                    # documents before the pivot cannot make it into the top-k
+                    for c in active[:pivot]:
+                        c.next_geq(pivot_doc)
+            decoded += sum(c.decoded for c in cursors)
+            t = stats.lap('scoring', t)
+
+        stats.count('postings_scanned', decoded)
+        stats.count('docs_scored', docs_scored)
+        return [(-neg_doc, score) for score, neg_doc in sorted(heap, reverse=True)]
+
+    def search_phrase(self, cleaned_phrase, k=10, window=None, stats=NULL_STATS):
+        # ranked list of the documents holding the terms of an analyzed phrase next to each other and in
+        # order, or with window set, all of them within `window` consecutive positions in any order
+        # matching documents are ranked by the BM25 score of the phrase terms
+        tok2idx = self.indexer.tok2idx
+        num_terms = len(self.indexer.idf)
+        terms = cleaned_phrase.split()
+        if not terms or any(tok2idx.get(term, num_terms) >= num_terms for term in terms):
+            return RankedList(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), k)
+        term_ids = [tok2idx[term] for term in terms]
+
+        segments = self.indexer.segments
+        t = stats.clock()
+        weights = self.idf_weights(Counter(term_ids))
+        t = stats.lap('idf', t)
+
+        doc_ids, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+        for segment in segments:
+            matched = self.phrase_matches(segment, term_ids, window, stats=stats)
+            t = stats.clock()
+            doc_ids.append(segment.doc_ids[matched])
+            scores.append(self.score_matches(segment, weights, matched))
+            stats.count('docs_matched', len(matched))
+            stats.lap('scoring', t)
+        return RankedList(np.concatenate(doc_ids), np.concatenate(scores), k)
+
+    def phrase_matches(self, segment, term_ids, window=None, candidates=None, stats=NULL_STATS):
+        # increasing local ids of the live documents of a segment holding the terms as a phrase, or within
+        # `window` positions, see search_phrase; candidates optionally limits the documents checked
+        # the documents holding every term are found first, then only their positions are decoded and checked
+        t = stats.clock()
+        distinct = sorted(set(term_ids), key=segment.doc_freq)
+        if candidates is None:
+            # intersection driven by the shortest postings list, the others are only looked up
+            candidates = segment.live_postings(distinct[0])[0]
+            distinct_rest = distinct[1:]
+        else:
+            distinct_rest = distinct
+        for term_id in distinct_rest:
+            candidates = candidates[segment.term_freqs(term_id, candidates) > 0]
+        t = stats.lap('intersection', t)
+        stats.count('candidates', len(candidates))
+        if not len(candidates):
+            return candidates
+
+        # every position of a term in the candidates as an increasing key (candidate index << 32 | position)
+        keys = {}
+        for term_id in distinct:
+            offsets, positions = segment.term_positions(term_id, candidates)
+            keys[term_id] = (np.repeat(np.arange(len(candidates), dtype=np.int64), np.diff(offsets)) << 32) | positions
+            stats.count('positions_decoded', len(positions))
+        t = stats.lap('positions', t)
+
+        if window is None:
+            # a phrase starts at a position of its first term that the other terms follow in order
+            starts = keys[term_ids[0]]
+            for offset, term_id in enumerate(term_ids[1:], 1):
+                starts = starts[contains_sorted(keys[term_id], starts + offset)]
+        else:
+            # a window starts at a term position when every term occurs in the `window` positions from there
+            starts = np.unique(np.concatenate(list(keys.values())))
+            for term_keys in keys.values():
+                starts = starts[np.searchsorted(term_keys, starts + window) > np.searchsorted(term_keys, starts)]
+        matched = candidates[np.unique(starts >> 32)]
+        stats.lap('verification', t)
+        return matched
+
+    def idf_weights(self, query_terms):
+        # query term frequency times IDF of every (term id, query term frequency)
+        idf = self.indexer.idf
+        return {term_id: qtf * float(idf[term_id]) for term_id, qtf in sorted(query_terms.items())}
+
+    def score_matches(self, segment, weights, local_ids):
+        # BM25 scores of some documents of a segment for the weighted terms, the term frequencies
+        # are looked up through the skip tables so long postings lists are not decoded whole
+        norms = self.indexer.norms[segment.doc_ids[local_ids]]
+        scores = np.zeros(len(local_ids), dtype=np.float64)
+        for term_id, weight in weights.items():
+            tfs = segment.term_freqs(term_id, local_ids)
+            scores += weight * normed_tf_weight(tfs, norms, self.k1)
+        return scores
+
+    def search_boolean(self, q_str, k=10, stats=NULL_STATS):
+        # ranked list of the documents matching a boolean query (see boolean.py), ranked by the BM25
+        # score of the query terms that are not negated
+        t = stats.clock()
+        node = self.analyze_boolean(parse_query(q_str))
+        stats.lap('analysis', t)
+        if node is None:
+            return RankedList(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), k)
+
+        segments = self.indexer.segments
+        t = stats.clock()
+        weights = self.idf_weights(Counter(self.positive_terms(node)))
+        t = stats.lap('idf', t)
+
+        doc_ids, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+        for segment in segments:
+            matched = self.boolean_matches(segment, node, stats)
+            t = stats.clock()
+            doc_ids.append(segment.doc_ids[matched])
+            scores.append(self.score_matches(segment, weights, matched))
+            stats.count('docs_matched', len(matched))
+            stats.lap('scoring', t)
+        return RankedList(np.concatenate(doc_ids), np.concatenate(scores), k)
+
+    def analyze_boolean(self, node):
+        # analyze the words of a parsed boolean query like the documents: a word becomes ('term', term id)
+        # or ('phrase', term ids) when it analyzes into several terms, words that are not in the index
+        # become ('none',), and stopwords and operators left without operands are dropped (None)
+        kind = node[0]
+        if kind in ('term', 'phrase'):
+            terms = self.indexer.analyzer.analyze(node[1])
+            if not terms:
+                return None
+            num_terms = len(self.indexer.idf)
+            if any(self.indexer.tok2idx.get(term, num_terms) >= num_terms for term in terms):
+                return ('none',)
+            term_ids = [self.indexer.tok2idx[term] for term in terms]
+            return ('term', term_ids[0]) if len(term_ids) == 1 else ('phrase', term_ids)
+        if kind == 'not':
+            child = self.analyze_boolean(node[1])
+            return None if child is None else ('not', child)
+        children = [child for child in map(self.analyze_boolean, node[1]) if child is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else (kind, children)
+
+    def positive_terms(self, node):
+        # term ids of an analyzed boolean query that are not under a NOT, with repetitions
+        kind = node[0]
+        if kind == 'term':
+            return [node[1]]
+        if kind == 'phrase':
+            return list(node[1])
+        if kind in ('and', 'or'):
+            return [term_id for child in node[1] for term_id in self.positive_terms(child)]
+        return []
+
+    def estimate_matches(self, segment, node):
+        # upper bound of the number of documents of a segment matching an analyzed boolean query node,
+        # from the document frequencies without decoding anything
+        kind = node[0]
+        if kind == 'term':
+            return segment.doc_freq(node[1])
+        if kind == 'phrase':
+            return min(segment.doc_freq(term_id) for term_id in node[1])
+        if kind == 'none':
+            return 0
+        if kind == 'not':
+            return segment.num_docs
+        if kind == 'or':
+            return sum(self.estimate_matches(segment, child) for child in node[1])
+        return min(self.estimate_matches(segment, child) for child in node[1])
+
+    def boolean_matches(self, segment, node, stats=NULL_STATS):
+        # increasing local ids of the live documents of a segment matching an analyzed boolean query node
+        kind = node[0]
+        if kind == 'term':
+            return segment.live_postings(node[1])[0]
+        if kind == 'phrase':
+            return self.phrase_matches(segment, node[1], stats=stats)
+        if kind == 'none':
+            return np.zeros(0, dtype=np.int32)
+        if kind == 'not':
+            candidates = self.live_local_ids(segment)
+            return candidates[~self.boolean_filter(segment, node[1], candidates, stats)]
+        if kind == 'or':
+            return np.unique(np.concatenate([self.boolean_matches(segment, child, stats) for child in node[1]]))
+
+        # conjunction driven by the operand with the fewest documents: only that operand is evaluated
+        # over the segment, the other operands just check its documents, cheapest estimate first
+        children = sorted(node[1], key=lambda child: self.estimate_matches(segment, child))
+        if children[0][0] == 'not':
+            candidates = self.live_local_ids(segment)
+        else:
+            candidates = self.boolean_matches(segment, children[0], stats)
+            children = children[1:]
+        for child in children:
+            if not len(candidates):
+                break
+            candidates = candidates[self.boolean_filter(segment, child, candidates, stats)]
+        return candidates
+
+    def boolean_filter(self, segment, node, candidates, stats=NULL_STATS):
+        # mask of the candidates (increasing local ids of live documents) matching an analyzed boolean
+        # query node, every operand only checks the candidates the previous ones left open
+        kind = node[0]
+        if kind == 'term':
+            return segment.term_freqs(node[1], candidates) > 0
+        if kind == 'phrase':
+            return contains_sorted(self.phrase_matches(segment, node[1], candidates=candidates, stats=stats), candidates)
+        if kind == 'none':
+            return np.zeros(len(candidates), dtype=bool)
+        if kind == 'not':
+            return ~self.boolean_filter(segment, node[1], candidates, stats)
+        if kind == 'and':
+            mask = np.ones(len(candidates), dtype=bool)
+            for child in sorted(node[1], key=lambda child: self.estimate_matches(segment, child)):
+                mask[mask] = self.boolean_filter(segment, child, candidates[mask], stats)
+        else:
+            mask = np.zeros(len(candidates), dtype=bool)
+            for child in node[1]:
+                mask[~mask] = self.boolean_filter(segment, child, candidates[~mask], stats)
+        return mask
+
+    def live_local_ids(self, segment):
+        # local ids of the documents of a segment that are not deleted
+        if segment.deleted is None:
+            return np.arange(segment.num_docs, dtype=np.int32)
+        return np.flatnonzero(~segment.deleted).astype(np.int32)
+
+    def calculate_bm25_scores(self, cleaned_query):
+        # reference implementation: scores one posting at a time into a dictionary
+        # Create a dictionary to store document scores, only documents containing a query term get an entry
+        results = defaultdict(float)
+
+        # Number of documents (N) and average document length (avgdl) from corpus stats
+        num_docs = self.indexer.corpus_stats['num_docs']
+        avgdl = self.indexer.corpus_stats['avgdl']
+
+        # Iterate through the postings of each query term and accumulate scores
+        query_terms = cleaned_query.split()
+        for term in query_terms:
+            # terms that are not in the index have no postings and add nothing to the scores
+            if term not in self.indexer.tok2idx:
+                continue
+            doc_ids, tfs = self.indexer.get_postings(self.indexer.tok2idx[term])
+
+            # Calculate IDF (inverse document frequency) for the query term
+            df_term = len(doc_ids)
+            idf_term = math.log((num_docs - df_term + 0.5) / (df_term + 0.5) + 1.0)
+
+            for doc_id, tf_term in zip(doc_ids.tolist(), tfs.tolist()):
+                # Document length (|D|) computed once at index time
+                doc_length = self.indexer.doc_lengths[doc_id]
 
                 # Calculate BM25 score for the term in the document
-                score_term = (idf_values[term] * tf_term * (self.k1 + 1)) / (
+                score_term = (idf_term * tf_term * (self.k1 + 1)) / (
                     tf_term + self.k1 * ((1 - self.b) + self.b * (doc_length / avgdl))
                 )
 
-                doc_score += score_term
-
-            results[doc_id] = doc_score
+                results[doc_id] += score_term
 
         return results
 
     def display_results(self, results):
 
-        for docid, score in results[:5]:  # print top 5 results
+        for docid, score in results:  # print the top-k results
             print(f'\nDocID: {docid}')
             print(f'Score: {score}')
             print('Article:')
-            print(self.indexer.raw_ds[docid])
+            print(self.indexer.get_document(docid))
+
+
 
+# search agent of the current worker process, set up once by init_search_worker
+worker_agent = None
+
+
+def init_search_worker(dbfile):
+    # open the index in a worker process of query_batch, its files are mapped and shared with the other processes
+    global worker_agent
+    Indexer.dbfile = dbfile
+    worker_agent = SearchAgent(Indexer(read_only=True))
+
+
+def search_in_worker(cleaned_queries, k, method, generation):
+    # the workers outlive index updates, they reopen the index when it is at another generation
+    if worker_agent.indexer.generation != generation:
+        worker_agent.indexer.load_index_data()
+    return worker_agent.search_batch(cleaned_queries, k, method)
 
 
 if __name__ == "__main__":
-    i = Indexer()           # instantiate an indexer
+    parser = argparse.ArgumentParser(description='BM25 indexer and search engine')
+    parser.add_argument('--dbfile', default=Indexer.dbfile)
+    parser.add_argument('--jsonl', help='JSON lines file to build a new index from instead of the dataset')
+    parser.add_argument('--field', default='article', help='field of the JSON lines records holding the text')
+    args = parser.parse_args()
+
+    Indexer.dbfile = args.dbfile
+    documents = iter_jsonl(args.jsonl, args.field) if args.jsonl else None
+    i = Indexer(documents)  # instantiate an indexer
     q = SearchAgent(i)      # document retriever
     code.interact(local=dict(globals(), **locals())) # interactive shell
\ No newline at end of file
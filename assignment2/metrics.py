@@ -0,0 +1,230 @@
+"""
+Metrics registry exposed in the Prometheus text exposition format.
+
+Counters and histograms are updated on the query path, so every thread writes to a shard of its own
+and the shards are only added up when the metrics are scraped; updating a metric takes no lock.
+Values that already exist elsewhere (cache counters, index size) are read by callbacks at scrape time
+and cost nothing in between.
+
+    registry.counter(name, help, labelnames).labels(method='bmw').inc()
+    registry.histogram(name, help, labelnames, buckets).labels(...).observe(seconds)
+    registry.gauge_callback(name, help, callback)   callback returns a number or [(labels, value), ...]
+    start_http_server(registry, port)               serves /metrics from a background thread
+"""
+import os
+import time
+import bisect
+import resource
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+# latency buckets in seconds, from 50 microseconds to 10 seconds
+latency_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Sharded:
+    # numbers that every thread updates in a list of its own, added up when read
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()    # only taken the first time a thread updates the metric
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = [0] * self.size
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [sum(values) for values in zip(*shards)] if shards else [0] * self.size
+
+
+class CounterChild(Sharded):
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, n=1):
+        self.shard()[0] += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.totals()[0]
+
+
+class HistogramChild(Sharded):
+    # counts per bucket, then the sum of the observed values
+
+    def __init__(self, buckets):
+        super().__init__(len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self, name, labels):
+        totals = self.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals[:-1]):
+            cumulative += count
+            yield name + '_bucket', dict(labels, le=format_value(bound)), cumulative
+        yield name + '_sum', labels, totals[-1]
+        yield name + '_count', labels, cumulative
+
+
+class Family:
+    # a metric and its children, one per combination of label values
+
+    def __init__(self, name, help, kind, labelnames, make_child):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.make_child = make_child
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.make_child())
+        return child
+
+    def samples(self):
+        for key, child in list(self.children.items()):
+            yield from child.samples(self.name, dict(zip(self.labelnames, key)))
+
+
+class CallbackFamily:
+    # a metric whose value is read from a callback when scraped
+
+    def __init__(self, name, help, kind, callback):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, (int, float)):
+            value = [({}, value)]
+        for labels, v in value:
+            yield self.name, labels, v
+
+
+class Registry:
+    # named metrics of the process; asking again for an existing name returns the same metric,
+    # and a callback registered again replaces the previous one
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _family(self, name, kind, make):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = make()
+            elif family.kind != kind:
+                raise ValueError(f'metric {name} is already registered as a {family.kind}')
+            return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._family(name, 'counter', lambda: Family(name, help, 'counter', labelnames, CounterChild))
+
+    def histogram(self, name, help, labelnames=(), buckets=latency_buckets):
+        buckets = tuple(sorted(buckets))
+        return self._family(name, 'histogram',
+                            lambda: Family(name, help, 'histogram', labelnames, lambda: HistogramChild(buckets)))
+
+    def gauge_callback(self, name, help, callback):
+        self._register_callback(name, help, 'gauge', callback)
+
+    def counter_callback(self, name, help, callback):
+        self._register_callback(name, help, 'counter', callback)
+
+    def _register_callback(self, name, help, kind, callback):
+        with self.lock:
+            family = self.families.get(name)
+            if family is not None and family.kind != kind:
+                raise ValueError(f'metric {name} is already registered as a {family.kind}')
+            self.families[name] = CallbackFamily(name, help, kind, callback)
+
+    def expose(self):
+        # all metrics in the Prometheus text exposition format
+        with self.lock:
+            families = list(self.families.values())
+        lines = []
+        for family in families:
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for name, labels, value in family.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def resident_memory_bytes():
+    # current resident set size, or the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def register_process_metrics(registry):
+    registry.gauge_callback('process_resident_memory_bytes', 'Resident memory size in bytes.', resident_memory_bytes)
+    registry.counter_callback('process_cpu_seconds_total', 'User and system CPU time in seconds.', time.process_time)
+    registry.gauge_callback('process_threads', 'Number of threads.', threading.active_count)
+
+
+# registry of the process, used by Indexer, SearchAgent and server.py
+registry = Registry()
+register_process_metrics(registry)
+
+
+def start_http_server(registry=registry, port=9100, host='127.0.0.1'):
+    # serve GET /metrics from a daemon thread, for processes that do not run server.py
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
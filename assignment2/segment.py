@@ -0,0 +1,426 @@
+"""
+Immutable on-disk index segments. An index directory holds
+    manifest.json           index generation, live segments in doc id order, settings
+    terms.txt               the global lexicon shared by all segments, one term per line, line number = term id
+    analysis.json           token to term cache of the analyzer (see analysis.py)
+    norms_<gen>.npy, idf_<gen>.npy  BM25 length norm of every doc id and IDF of every term id, with the index
+    tables_<gen>.json       generation and BM25 parameters they belong to (see Indexer.update_score_tables)
+    seg_NNNNNN/             one directory per segment
+A segment directory is made of separate files that are memory-mapped when opened:
+    meta.json               segment statistics and settings
+    term_ids.npy            increasing ids of the terms with postings in this segment, one row per term
+                            in the tables below
+    postings.bin            compressed postings lists of these terms in term id order (see compression.py)
+    postings_offsets.npy    byte offset of every term's postings list in postings.bin, plus the end offset
+    doc_freqs.npy           number of postings of every term in this segment
+    max_scores.npy          BM25 tf weight upper bound of every term
+    block_max_offsets.npy   offset of every term's first block bound in block_max_scores.npy, plus the end offset
+    block_max_scores.npy    BM25 tf weight upper bound of every block of postings
+    doc_ids.npy             global doc id of every document of the segment, increasing
+    doc_lengths.npy         length of every document
+    forward.bin             forward index, the term ids of every document back to back (int32)
+    forward_offsets.npy     offset of every document's term ids in forward.bin, plus the end offset
+    positions.bin           optional term positions, one section per block of postings (see encode_positions)
+    positions_offsets.npy   byte offset of every block's positions in positions.bin, indexed like
+                            block_max_scores.npy, plus the end offset
+    docs.*, doc_*.npy       block-compressed document store (see docstore.py)
+    deleted_NNNNNN.npy      deleted documents as a packed bitset, one file per deletes generation
+Postings inside a segment use local doc ids, the position of the document in the segment.
+Positions are the indexes of the terms in the analyzed document, like in the forward index. They are
+only mapped when a phrase or window query first needs them, and segments written without positions
+answer those queries from the forward index instead.
+Segments are never modified once written; new documents go to new segments and merges write a new
+segment that replaces the merged ones in the manifest. Deleting documents only adds a new bitset
+file, the manifest records which deletes generation of every segment is current.
+"""
+import os
+import copy
+import json
+import shutil
+import numpy as np
+from compression import codecs, CompressedPostings, decode_positions
+from docstore import DocStoreWriter, DocStore, map_file
+
+
+def gather_ranges(values, starts, lengths):
+    # (offsets, concatenation of the ranges values[starts[i]:starts[i] + lengths[i]]), the i-th range
+    # ends up in [offsets[i]:offsets[i + 1]]
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return offsets, values[index]
+
+
+def lookup_sorted(keys, values, queries):
+    # values of the queries in an increasing array of keys, 0 for the queries that are not keys
+    found = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[found] == queries, values[found], 0)
+
+
+class SegmentWriter:
+    # writes a segment directory in one pass: documents first, then the postings in term id order
+    # the files go to a temporary directory that is renamed into place by finish(), so readers
+    # never see a half written segment
+
+    def __init__(self, path, doc_compression='zlib', positions=False):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self.docstore = DocStoreWriter(self.tmp_path, doc_compression)
+        self.forward_file = open(os.path.join(self.tmp_path, 'forward.bin'), 'wb')
+        self.postings_file = open(os.path.join(self.tmp_path, 'postings.bin'), 'wb')
+        self.doc_ids = []
+        self.doc_lengths = []
+        # per-term tables, only for the terms with postings in this segment, kept as arrays per batch of terms
+        self.term_ids = []
+        self.postings_sizes = []
+        self.doc_freqs = []
+        self.max_scores = []
+        self.num_blocks = []
+        self.block_max_scores = []
+        self.last_term_id = -1
+        self.positions_file = open(os.path.join(self.tmp_path, 'positions.bin'), 'wb') if positions else None
+        self.positions_sizes = []
+
+    def add_document(self, doc_id, document, term_ids):
+        # global doc id, raw text and term id array of the next document
+        self.docstore.add(document)
+        self.forward_file.write(np.asarray(term_ids, dtype=np.int32).tobytes())
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(len(term_ids))
+
+    def add_postings(self, term_id, data, doc_freq, max_score, block_max_scores, positions=None):
+        # compressed postings list and score bounds of a term, terms must come in increasing term id order
+        # positions are the sections of encode_positions(), one per block, required when the segment stores positions
+        self.add_postings_batch([term_id], data, [len(data)], [doc_freq], [max_score],
+                                block_max_scores, [len(block_max_scores)], positions)
+
+    def add_postings_batch(self, term_ids, data, sizes, doc_freqs, max_scores, block_max_scores, num_blocks,
+                           positions=None):
+        # add_postings() of consecutive terms at once: their compressed lists back to back in data with
+        # their byte sizes, and the block bounds of all of them back to back with the number of blocks of each
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        if len(term_ids) == 0:
+            return
+        if term_ids[0] <= self.last_term_id or np.any(np.diff(term_ids) <= 0):
+            raise ValueError(f'postings out of term id order: {int(term_ids[0])}')
+        if self.positions_file is not None:
+            if positions is None or len(positions) != len(block_max_scores):
+                raise ValueError(f'positions missing for terms from {int(term_ids[0])}')
+            for section in positions:
+                self.positions_file.write(section)
+            self.positions_sizes.append(np.array([len(section) for section in positions], dtype=np.int64))
+        self.postings_file.write(data)
+        self.term_ids.append(term_ids)
+        self.postings_sizes.append(np.asarray(sizes, dtype=np.int64))
+        self.doc_freqs.append(np.asarray(doc_freqs, dtype=np.int32))
+        self.max_scores.append(np.asarray(max_scores, dtype=np.float64))
+        self.num_blocks.append(np.asarray(num_blocks, dtype=np.int64))
+        self.block_max_scores.append(np.asarray(block_max_scores, dtype=np.float64))
+        self.last_term_id = int(term_ids[-1])
+
+    def finish(self, meta):
+        # write the offsets, statistics and settings and move the segment into place
+        self.docstore.close()
+        self.forward_file.close()
+        self.postings_file.close()
+
+        def offsets(sizes):
+            return np.concatenate(([0], np.cumsum(np.concatenate(sizes), dtype=np.int64))) if sizes else np.zeros(1, dtype=np.int64)
+
+        def concatenate(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+        if self.positions_file is not None:
+            self.positions_file.close()
+            np.save(os.path.join(self.tmp_path, 'positions_offsets.npy'), offsets(self.positions_sizes))
+
+        doc_lengths = np.array(self.doc_lengths, dtype=np.int32)
+        np.save(os.path.join(self.tmp_path, 'doc_ids.npy'), np.array(self.doc_ids, dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, 'doc_lengths.npy'), doc_lengths)
+        np.save(os.path.join(self.tmp_path, 'forward_offsets.npy'), np.cumsum(np.concatenate(([0], doc_lengths)), dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, 'term_ids.npy'), concatenate(self.term_ids, np.int32))
+        np.save(os.path.join(self.tmp_path, 'postings_offsets.npy'), offsets(self.postings_sizes))
+        np.save(os.path.join(self.tmp_path, 'doc_freqs.npy'), concatenate(self.doc_freqs, np.int32))
+        np.save(os.path.join(self.tmp_path, 'max_scores.npy'), concatenate(self.max_scores, np.float64))
+        np.save(os.path.join(self.tmp_path, 'block_max_offsets.npy'), offsets(self.num_blocks))
+        np.save(os.path.join(self.tmp_path, 'block_max_scores.npy'), concatenate(self.block_max_scores, np.float64))
+
+        meta = dict(meta, num_docs=len(doc_lengths), total_length=int(doc_lengths.sum()),
+                    positions=self.positions_file is not None)
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+class Segment:
+    # read-only, memory-mapped view of a segment directory
+    # decoded postings lists are shared through postings_cache (see cache.py) when one is given
+
+    def __init__(self, path, postings_cache=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.postings_cache = postings_cache
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.codec = codecs[self.meta['postings_codec']]
+
+        self.postings_data = map_file(os.path.join(path, 'postings.bin'))
+        # the per-term tables have a row for every term with postings, listed in term_ids.npy
+        self.term_ids = self._load('term_ids.npy')
+        self.postings_offsets = self._load('postings_offsets.npy')
+        self.doc_freqs = self._load('doc_freqs.npy')
+        self.max_scores = self._load('max_scores.npy')
+        self.block_max_offsets = self._load('block_max_offsets.npy')
+        self.block_max_scores = self._load('block_max_scores.npy')
+        self.doc_ids = self._load('doc_ids.npy')
+        self.doc_lengths = self._load('doc_lengths.npy')
+        self.forward_data = map_file(os.path.join(path, 'forward.bin')).view(np.int32)
+        self.forward_offsets = self._load('forward_offsets.npy')
+        self.docstore = DocStore(path)
+        self.num_terms = int(self.term_ids[-1]) + 1 if len(self.term_ids) else 0   # term ids below this may have postings
+        self.num_docs = len(self.doc_ids)
+        self.has_positions = self.meta.get('positions', False)
+        # mapped up front like the other files: a merge removes the directory of the segments it replaced
+        # while readers may still hold them
+        self.positions_data = map_file(os.path.join(path, 'positions.bin')) if self.has_positions else None
+        self.positions_offsets = self._load('positions_offsets.npy') if self.has_positions else None
+        self._load_deletes(0)
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name), mmap_mode='r')
+
+    def _load_deletes(self, generation):
+        self.deletes_generation = generation
+        self.deleted = None         # boolean array over local ids, None when nothing is deleted
+        self.num_deleted = 0
+        self.live_length = self.meta['total_length']
+        self.deleted_doc_freqs = None   # postings of deleted documents per term, counted on first use
+        if generation:
+            bits = np.load(os.path.join(self.path, f'deleted_{generation:06d}.npy'))
+            self.deleted = np.unpackbits(bits, count=self.num_docs).astype(bool)
+            self.num_deleted = int(self.deleted.sum())
+            self.live_length -= int(self.doc_lengths[self.deleted].sum())
+
+    def with_deletes(self, generation):
+        # view of the segment with the deleted documents of a deletes generation, the mapped files
+        # are shared and the view the caller already holds is left unchanged
+        if generation == self.deletes_generation:
+            return self
+        segment = copy.copy(self)
+        segment._load_deletes(generation)
+        return segment
+
+    def write_deletes(self, deleted, generation):
+        # write a new deletes generation, deleted is a boolean array over local ids
+        bits = np.packbits(deleted)
+        tmp_path = os.path.join(self.path, f'deleted_{generation:06d}.tmp.npy')
+        np.save(tmp_path, bits)
+        os.replace(tmp_path, os.path.join(self.path, f'deleted_{generation:06d}.npy'))
+
+    def remove_deletes(self, generation):
+        # remove the bitset file of a deletes generation that is no longer current
+        if generation:
+            try:
+                os.remove(os.path.join(self.path, f'deleted_{generation:06d}.npy'))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def num_live_docs(self):
+        return self.num_docs - self.num_deleted
+
+    def is_deleted(self, local_id):
+        return self.deleted is not None and bool(self.deleted[local_id])
+
+    def row(self, term_id):
+        # row of a term in the per-term tables, None if the term has no postings in this segment
+        row = int(np.searchsorted(self.term_ids, term_id))
+        return row if row < len(self.term_ids) and self.term_ids[row] == term_id else None
+
+    def doc_freq(self, term_id):
+        # number of postings of a term in this segment, including deleted documents
+        row = self.row(term_id)
+        return 0 if row is None else int(self.doc_freqs[row])
+
+    def decoded_postings(self, term_id):
+        # decoded (local ids, term frequencies) of a term including deleted documents, from the
+        # postings cache when the term was decoded before
+        key = (self.path, term_id)
+        if self.postings_cache is not None:
+            decoded = self.postings_cache.get(key)
+            if decoded is not None:
+                return decoded
+
+        postings = self.postings(term_id)
+        if postings is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        local_ids, tfs = postings.decode()
+        local_ids.flags.writeable = False
+        tfs.flags.writeable = False
+        if self.postings_cache is not None:
+            self.postings_cache.put(key, (local_ids, tfs), local_ids.nbytes + tfs.nbytes)
+        return local_ids, tfs
+
+    def live_doc_freq(self, term_id):
+        # number of postings of a term in this segment that belong to documents that are not deleted
+        row = self.row(term_id)
+        if row is None:
+            return 0
+        if self.deleted is None:
+            return int(self.doc_freqs[row])
+        return int(self.doc_freqs[row]) - int(self.deleted_doc_freq_table()[row])
+
+    def live_doc_freq_table(self):
+        # live_doc_freq() of every term of the segment as an array, a row per term of term_ids
+        if self.deleted is None:
+            return self.doc_freqs
+        return self.doc_freqs - self.deleted_doc_freq_table()
+
+    def deleted_doc_freq_table(self):
+        # number of deleted documents holding every term, counted from the forward index of the deleted
+        # documents once per deletes generation, so the cost is in the deleted tokens and not in the postings
+        if self.deleted_doc_freqs is None:
+            deleted = np.flatnonzero(self.deleted)
+            lengths = self.doc_lengths[deleted]
+            offsets, term_ids = gather_ranges(self.forward_data, self.forward_offsets[deleted], lengths)
+            # every (deleted document, term) pair counts once, counted in the row of the term
+            pairs = np.unique(np.repeat(np.arange(len(deleted), dtype=np.int64), lengths) * self.num_terms + term_ids)
+            rows = np.searchsorted(self.term_ids, pairs % self.num_terms)
+            self.deleted_doc_freqs = np.bincount(rows, minlength=len(self.term_ids)).astype(np.int32)
+        return self.deleted_doc_freqs
+
+    def live_postings(self, term_id):
+        # decoded (local ids, term frequencies) of a term without the deleted documents
+        local_ids, tfs = self.decoded_postings(term_id)
+        if self.deleted is not None:
+            live = ~self.deleted[local_ids]
+            local_ids, tfs = local_ids[live], tfs[live]
+        return local_ids, tfs
+
+    def term_freqs(self, term_id, local_ids):
+        # term frequency of a term in every document of an increasing array of local ids, 0 for the
+        # documents without the term; deleted documents are not checked
+        # a postings list in the postings cache is searched whole, otherwise the skip table leads to
+        # the blocks the local ids fall into and only those are decoded, so looking up a few documents
+        # in a long list costs O(few * log long) and leaves the rest of the list untouched
+        freqs = np.zeros(len(local_ids), dtype=np.int32)
+        postings = self.postings(term_id)
+        if postings is None or len(local_ids) == 0:
+            return freqs
+        if len(local_ids) >= postings.num_blocks or (self.postings_cache is not None
+                                                     and (self.path, term_id) in self.postings_cache):
+            return lookup_sorted(*self.decoded_postings(term_id), local_ids)
+
+        blocks, starts = np.unique(np.searchsorted(postings.block_last_docs, local_ids), return_index=True)
+        ends = np.append(starts[1:], len(local_ids))
+        for block, start, end in zip(blocks.tolist(), starts.tolist(), ends.tolist()):
+            if block < postings.num_blocks:
+                freqs[start:end] = lookup_sorted(*postings.block(block), local_ids[start:end])
+        return freqs
+
+    def postings(self, term_id):
+        # compressed postings list of a term read straight from the mapped file, None if the term
+        # has no postings in this segment
+        row = self.row(term_id)
+        if row is None:
+            return None
+        start, end = self.postings_offsets[row], self.postings_offsets[row + 1]
+        return CompressedPostings(self.postings_data[start:end], self.codec)
+
+    def score_bounds(self, term_id, avgdl):
+        # (upper bound over the whole list, array of upper bounds per block) of a term's BM25 tf weight
+        # the bounds were computed with the avgdl at the time the segment was written; the tf weight
+        # grows by at most avgdl / bound_avgdl when avgdl grows, so scaling by that keeps them valid
+        # queries score with float32 length norms (see Indexer.norms), the small slack covers their rounding
+        scale = max(1.0, avgdl / self.meta['bound_avgdl']) * (1 + 1e-6)
+        row = self.row(term_id)
+        start, end = self.block_max_offsets[row], self.block_max_offsets[row + 1]
+        return float(self.max_scores[row]) * scale, self.block_max_scores[start:end] * scale
+
+    def term_positions(self, term_id, local_ids):
+        # positions of a term in some of the documents holding it, given as increasing local ids:
+        # (offsets, positions) with the positions in the i-th document in positions[offsets[i]:offsets[i + 1]]
+        # only the blocks of positions that hold these documents are decoded
+        if not self.has_positions or len(local_ids) == 0:
+            return self._forward_positions(term_id, local_ids)
+
+        all_ids, tfs = self.decoded_postings(term_id)
+        postings = np.searchsorted(all_ids, local_ids)
+        block_size = self.meta['block_size']
+        blocks = np.unique(postings // block_size)
+        first_block = int(self.block_max_offsets[self.row(term_id)])
+        starts, parts = [], []
+        decoded = 0
+        for block in blocks.tolist():
+            start = first_block + block
+            data = self.positions_data[self.positions_offsets[start]:self.positions_offsets[start + 1]]
+            offsets, positions = decode_positions(data, tfs[block * block_size:(block + 1) * block_size])
+            starts.append(offsets[:-1] + decoded)
+            parts.append(positions)
+            decoded += len(positions)
+
+        # gather the positions of the requested postings out of the decoded blocks, every block but
+        # the last one of a term holds block_size postings
+        rows = np.searchsorted(blocks, postings // block_size) * block_size + postings % block_size
+        return gather_ranges(np.concatenate(parts), np.concatenate(starts)[rows], tfs[postings])
+
+    def _forward_positions(self, term_id, local_ids):
+        # term_positions() of a segment without positions, read from the forward index
+        parts = [np.flatnonzero(self.doc_terms(local_id) == term_id).astype(np.int32) for local_id in local_ids]
+        offsets = np.concatenate(([0], np.cumsum([len(part) for part in parts], dtype=np.int64)))
+        return offsets, np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32)
+
+    def local_id(self, doc_id):
+        # position of a global doc id in this segment, None if the segment does not hold it
+        # or the document is deleted
+        local = int(np.searchsorted(self.doc_ids, doc_id))
+        if local < self.num_docs and self.doc_ids[local] == doc_id and not self.is_deleted(local):
+            return local
+        return None
+
+    def doc_terms(self, local_id):
+        # term ids of a document, in document order
+        start, end = self.forward_offsets[local_id], self.forward_offsets[local_id + 1]
+        return self.forward_data[start:end]
+
+    def document(self, local_id):
+        # raw text of a document
+        return self.docstore.get(local_id)
+
+
+class TieredMergePolicy:
+    # groups segments into size tiers growing by merge_factor and merges merge_factor adjacent
+    # segments of the same tier into one, so the number of segments stays logarithmic in the index size
+    # a segment with more than max_deleted_ratio of its documents deleted is rewritten on its own
+    # to reclaim the space of the deleted postings
+
+    def __init__(self, merge_factor=10, min_segment_docs=1000, max_deleted_ratio=0.3):
+        self.merge_factor = merge_factor
+        self.min_segment_docs = min_segment_docs
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def tier(self, num_docs):
+        tier = 0
+        size = max(num_docs, self.min_segment_docs) // self.min_segment_docs
+        while size >= self.merge_factor:
+            size //= self.merge_factor
+            tier += 1
+        return tier
+
+    def find_merge(self, segment_sizes, deleted_counts=None):
+        # (start, end) of a window of adjacent segments to merge, None when nothing needs merging
+        for i, num_deleted in enumerate(deleted_counts or ()):
+            if num_deleted > self.max_deleted_ratio * segment_sizes[i]:
+                return i, i + 1
+        tiers = [self.tier(size) for size in segment_sizes]
+        for start in range(len(tiers) - self.merge_factor + 1):
+            window = tiers[start:start + self.merge_factor]
+            if all(tier == window[0] for tier in window):
+                return start, start + self.merge_factor
+        return None
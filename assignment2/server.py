@@ -0,0 +1,179 @@
+"""
+HTTP search service for the index in ./ir.idx, built on asyncio streams from the standard library.
+    GET /search?q=<query>&k=<depth>&method=<taat|wand|bmw|sparse>&mode=<ranked|boolean>
+                                                ranked doc ids and scores as JSON, with mode=boolean
+                                                the query uses the syntax of boolean.py and method is ignored
+    GET /doc/<doc id>                           raw text of a document as JSON
+    GET /metrics                                metrics in the Prometheus text format
+The index is loaded once at startup. Scoring and document reads run in a thread pool so the event
+loop keeps accepting and answering other clients while a query is being ranked. Connections are
+kept alive between requests (HTTP/1.1).
+
+    python server.py [--host 127.0.0.1] [--port 8080] [--threads 4]
+"""
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+from main import Indexer, SearchAgent, methods, modes
+import metrics
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SearchServer:
+    max_k = 1000                # largest result depth a client may ask for
+    max_header_bytes = 16384    # requests with a longer request line and headers are refused
+
+    def __init__(self, agent, num_threads=4, registry=metrics.registry):
+        self.agent = agent
+        # NLTK loads WordNet on the first lemmatization and its lazy loader is not thread-safe, so the
+        # first queries of the request threads could race on it: load it before serving
+        agent.indexer.analyzer.lemmatizer.lemmatize('documents')
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.registry = registry
+        self.requests_metric = registry.counter('http_requests_total', 'HTTP requests answered.', ['route', 'status'])
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle, host, port, limit=self.max_header_bytes)
+        print(f'serving on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        # answer the requests of one connection until the client closes it or asks to
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request_line = lines[0].split()
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                # GET requests have no body, skip it if a client sends one anyway
+                length = int(headers.get('content-length') or 0)
+                if length:
+                    await reader.readexactly(length)
+
+                keep_alive = (len(request_line) == 3 and request_line[2] == 'HTTP/1.1'
+                              and headers.get('connection', '').lower() != 'close')
+                route, status, payload = await self.dispatch(request_line)
+                self.requests_metric.labels(route=route, status=status).inc()
+                if isinstance(payload, str):
+                    body, content_type = payload.encode('utf-8'), metrics.content_type
+                else:
+                    body, content_type = json.dumps(payload).encode('utf-8'), 'application/json; charset=utf-8'
+                writer.write(f'HTTP/1.1 {status} {reasons[status]}\r\n'
+                             f'Content-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request_line):
+        # (route, status, payload) of a request, the payload is sent as JSON or as plain text if it is a string
+        route = 'other'
+        try:
+            if len(request_line) != 3:
+                raise HTTPError(400, 'malformed request line')
+            method, target, _ = request_line
+            if method != 'GET':
+                raise HTTPError(405, f'method not allowed: {method}')
+            url = urlsplit(target)
+            if url.path == '/search':
+                route = 'search'
+                return route, 200, await self.search(parse_qs(url.query))
+            if url.path.startswith('/doc/'):
+                route = 'doc'
+                return route, 200, await self.document(unquote(url.path[len('/doc/'):]))
+            if url.path == '/metrics':
+                route = 'metrics'
+                return route, 200, self.registry.expose()
+            raise HTTPError(404, f'not found: {url.path}')
+        except HTTPError as e:
+            return route, e.status, {'error': str(e)}
+        except Exception as e:
+            print(f'error handling {request_line}: {e!r}')
+            return route, 500, {'error': 'internal server error'}
+
+    async def search(self, params):
+        q_str = params.get('q', [''])[0]
+        if not q_str.strip():
+            raise HTTPError(400, 'missing query parameter q')
+        try:
+            k = int(params.get('k', ['10'])[0])
+        except ValueError:
+            raise HTTPError(400, 'k must be an integer')
+        if not 0 <= k <= self.max_k:
+            raise HTTPError(400, f'k must be between 0 and {self.max_k}')
+        method = params.get('method', ['taat'])[0]
+        if method not in methods:
+            raise HTTPError(400, f'unknown method: {method}')
+        mode = params.get('mode', ['ranked'])[0]
+        if mode not in modes:
+            raise HTTPError(400, f'unknown mode: {mode}')
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.rank, q_str, k, method, mode)
+        except ValueError as e:
+            # malformed boolean query
+            raise HTTPError(400, str(e))
+        return {
+            'query': q_str,
+            'k': k,
+            'method': method,
+            'mode': mode,
+            'took_ms': (time.perf_counter() - start) * 1000,
+            'results': [{'doc_id': doc_id, 'score': score} for doc_id, score in results]
+        }
+
+    def rank(self, q_str, k, method, mode):
+        # analyze and rank a query, runs in the thread pool
+        if mode == 'boolean':
+            return list(self.agent.search_boolean(q_str, k))
+        cleaned_query = self.agent.indexer.clean_text([q_str], query=True)[0]
+        return list(self.agent.search(cleaned_query, k, method))
+
+    async def document(self, doc_id):
+        try:
+            doc_id = int(doc_id)
+        except ValueError:
+            raise HTTPError(400, f'invalid doc id: {doc_id}')
+        loop = asyncio.get_running_loop()
+        try:
+            text = await loop.run_in_executor(self.executor, self.agent.indexer.get_document, doc_id)
+        except KeyError:
+            raise HTTPError(404, f'unknown doc id: {doc_id}')
+        return {'doc_id': doc_id, 'text': text}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='HTTP search service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=4, help='threads scoring queries and reading documents')
+    args = parser.parse_args()
+
+    agent = SearchAgent(Indexer())  # loads the index once, building it first if ./ir.idx does not exist
+    asyncio.run(SearchServer(agent, args.threads).serve(args.host, args.port))
@@ -0,0 +1,297 @@
+"""
+Document-sharded index: the corpus is split by doc id into N shards, every shard is an ordinary index
+(see main.py) opened by a worker process of its own, and queries are answered by scatter-gather.
+
+    ir.shards/
+        shards.json         number of shards
+        shard_00/ ...       index directory of every shard, see segment.py
+
+Document g is document g // N of shard g % N: new documents are dealt to the shards round-robin in
+doc id order, so every shard numbers its documents consecutively like an unsharded index does.
+
+BM25 depends on the whole corpus through the IDF and avgdl. After every change the coordinator runs a
+global statistics pass: it adds up the live documents, their lengths and the document frequency of
+every term over the shards and hands the totals back, and the shards score with them instead of their
+own (Indexer.set_global_stats). A query is analyzed once by the coordinator, broadcast to the shards,
+ranked by all of them at the same time with the query methods of SearchAgent, and the per-shard top-k
+lists are merged into the global top-k, which is the top-k of one index over the same documents.
+
+    python shards.py [--dbfile ./ir.shards] [--shards 4]
+"""
+import os
+import json
+import shutil
+import time
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+import numpy as np
+from nltk.corpus import stopwords
+from datasets import load_dataset
+from main import Indexer, SearchAgent, RankedList, BatchResults, iter_batches, modes
+from analysis import Analyzer
+import code
+
+
+# search agent of the current shard worker process, set up by serve_shard
+shard_agent = None
+
+
+def serve_shard(dbfile, conn):
+    # main loop of a shard worker process: open the index of the shard and answer the (name, args)
+    # requests of the coordinator with (ok, result) until it closes the pipe
+    global shard_agent
+    Indexer.dbfile = dbfile
+    Indexer.num_workers = 1     # the shards already take a process each
+    shard_agent = SearchAgent(Indexer(documents=()))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        name, args = request
+        try:
+            conn.send((True, shard_requests[name](*args)))
+        except Exception as e:
+            conn.send((False, e))
+    shard_agent.indexer.wait_for_merges()
+
+
+def set_global_stats(global_stats):
+    shard_agent.indexer.set_global_stats(global_stats)
+    # cached results and the score matrix were computed with the previous statistics
+    shard_agent.result_cache.clear()
+    shard_agent.matrix = None
+
+
+# requests a shard worker answers
+shard_requests = {
+    'local_stats': lambda: shard_agent.indexer.local_stats(),
+    'set_global_stats': set_global_stats,
+    'update_documents': lambda doc_ids, documents: shard_agent.indexer.update_documents(doc_ids, documents),
+    'wait_for_merges': lambda: shard_agent.indexer.wait_for_merges(),
+    'get_document': lambda doc_id: shard_agent.indexer.get_document(doc_id),
+    'search_batch': lambda cleaned_queries, k, method: shard_agent.search_batch(cleaned_queries, k, method),
+    'search_phrase': lambda cleaned_phrase, k, window: shard_agent.search_phrase(cleaned_phrase, k, window),
+    'search_boolean': lambda q_str, k: shard_agent.search_boolean(q_str, k),
+}
+
+
+class ShardedIndex:
+    dbfile = "./ir.shards"  # directory holding the index directory of every shard
+    num_shards = os.cpu_count() or 1    # number of shards of a new index, an existing one keeps its own
+    build_batch_size = 10000    # documents dealt to the shards at a time when building the index
+
+    def __init__(self, documents=None, num_shards=None):
+        # start a worker process per shard; documents is an optional iterable of raw texts to build
+        # the index from when it does not exist yet, like for Indexer
+        config_path = os.path.join(self.dbfile, 'shards.json')
+        exists = os.path.exists(config_path)
+        if exists:
+            with open(config_path) as f:
+                self.num_shards = json.load(f)['num_shards']
+        elif num_shards is not None:
+            self.num_shards = num_shards
+
+        self.stopwords = stopwords.words('english')
+        self.analyzer = Analyzer(self.stopwords)    # queries are analyzed once here, not by every shard
+        self.corpus_stats = {'avgdl': 0}            # statistics over all shards, see sync_stats
+        self.next_doc_id = 0                        # doc id of the next document added
+        self.lock = threading.Lock()                # one request at a time on the pipes to the shards
+        self.conns = []
+        self.processes = []
+        if not exists:
+            # shards.json is only written once every shard holds its documents, the shards of a build
+            # that failed or was interrupted are removed and the build starts over
+            os.makedirs(self.dbfile, exist_ok=True)
+            for name in os.listdir(self.dbfile):
+                if name.startswith('shard_'):
+                    shutil.rmtree(os.path.join(self.dbfile, name))
+        for shard in range(self.num_shards):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(self.shard_path(shard), child_conn), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+        if not exists:
+            # stream the dataset into the shards, the global statistics are computed once at the end
+            if documents is None:
+                ds = load_dataset("cnn_dailymail", '3.0.0', split="test", streaming=True)
+                documents = (row['article'] for row in ds)
+            try:
+                for batch in iter_batches(documents, self.build_batch_size):
+                    self.scatter_updates((), batch)
+            except BaseException:
+                self.close()
+                raise
+            with open(config_path, 'w') as f:
+                json.dump({'num_shards': self.num_shards}, f)
+        self.sync_stats()
+
+    def shard_path(self, shard):
+        return os.path.join(self.dbfile, f'shard_{shard:02d}')
+
+    def scatter(self, name, shard_args):
+        # send a request to every shard with arguments of its own, then gather the results in shard order
+        # the shards work on their requests at the same time
+        with self.lock:
+            for conn, args in zip(self.conns, shard_args):
+                conn.send((name, args))
+            replies = [conn.recv() for conn in self.conns]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def request(self, shard, name, *args):
+        # send a request to a single shard and wait for its result
+        with self.lock:
+            self.conns[shard].send((name, args))
+            ok, result = self.conns[shard].recv()
+        if not ok:
+            raise result
+        return result
+
+    def broadcast(self, name, *args):
+        # send the same request to every shard
+        return self.scatter(name, [args] * self.num_shards)
+
+    def sync_stats(self):
+        # global statistics pass: add up the live documents, their lengths and the document frequency
+        # of every term over the shards, and have every shard score with the totals so that the IDF
+        # and avgdl are those of the unsharded index
+        local_stats = self.broadcast('local_stats')
+        num_docs = sum(stats['num_docs'] for stats in local_stats)
+        total_length = sum(stats['total_length'] for stats in local_stats)
+        doc_freqs = Counter()
+        for stats in local_stats:
+            doc_freqs.update(dict(zip(stats['terms'], stats['doc_freqs'].tolist())))
+
+        # every shard gets the document frequencies of its own terms, indexed by its term ids
+        self.scatter('set_global_stats', [({
+            'num_docs': num_docs,
+            'total_length': total_length,
+            'doc_freqs': np.array([doc_freqs[term] for term in stats['terms']], dtype=np.int64)
+        },) for stats in local_stats])
+        self.corpus_stats = {
+            'num_docs': num_docs,
+            'total_length': total_length,
+            'avgdl': total_length / num_docs if num_docs else 0
+        }
+        self.next_doc_id = sum(stats['next_doc_id'] for stats in local_stats)
+
+    def locate(self, doc_id):
+        # (shard, doc id in the shard) of a doc id
+        if not 0 <= doc_id < self.next_doc_id:
+            raise KeyError(doc_id)
+        return doc_id % self.num_shards, doc_id // self.num_shards
+
+    def add_documents(self, documents):
+        # index a list of raw texts and return their doc ids
+        return self.update_documents((), documents)
+
+    def delete_documents(self, doc_ids):
+        self.update_documents(doc_ids, ())
+
+    def update_documents(self, doc_ids, documents):
+        # replace documents like Indexer.update_documents, every shard commits its part on its own
+        # and the new statistics are used once all of them are done
+        new_doc_ids = self.scatter_updates(doc_ids, documents)
+        self.sync_stats()
+        return new_doc_ids
+
+    def scatter_updates(self, doc_ids, documents):
+        # hand every shard its deletes and its round-robin share of the new documents
+        documents = list(documents)
+        shard_deletes = [[] for _ in range(self.num_shards)]
+        for doc_id in doc_ids:
+            shard, local_id = self.locate(doc_id)
+            shard_deletes[shard].append(local_id)
+        first = self.next_doc_id
+        shard_documents = [documents[(shard - first) % self.num_shards::self.num_shards]
+                           for shard in range(self.num_shards)]
+        local_ids = self.scatter('update_documents', list(zip(shard_deletes, shard_documents)))
+
+        self.next_doc_id = first + len(documents)
+        return sorted(local_id * self.num_shards + shard
+                      for shard, shard_ids in enumerate(local_ids) for local_id in shard_ids)
+
+    def wait_for_merges(self):
+        self.broadcast('wait_for_merges')
+
+    def get_document(self, doc_id):
+        shard, local_id = self.locate(doc_id)
+        return self.request(shard, 'get_document', local_id)
+
+    def gather(self, shard_results, k):
+        # merge the top-k lists of the shards into the global top-k: a document of the global top-k is
+        # in the top-k of its shard, and ties are broken by global doc id like in a single index
+        doc_ids = np.concatenate([results.candidate_ids.astype(np.int64) * self.num_shards + shard
+                                  for shard, results in enumerate(shard_results)])
+        scores = np.concatenate([results.candidate_scores.astype(np.float64) for results in shard_results])
+        return RankedList(doc_ids, scores, k).top()
+
+    def clean_query(self, q_str):
+        return ' '.join(self.analyzer.analyze(q_str, query=True))
+
+    def query(self, q_str, k=10, method='taat', mode='ranked'):
+        # rank a query string like SearchAgent.query, without displaying the results
+        if mode not in modes:
+            raise ValueError(f'unknown query mode: {mode}')
+        if mode == 'boolean':
+            return self.search_boolean(q_str, k)
+        return self.search(self.clean_query(q_str), k, method)
+
+    def query_batch(self, queries, k=10, method='taat'):
+        # rank a list of query strings, returns BatchResults like SearchAgent.query_batch
+        start = time.perf_counter()
+        results = self.search_batch([self.clean_query(q_str) for q_str in queries], k, method)
+        return BatchResults(results, time.perf_counter() - start)
+
+    def search(self, cleaned_query, k=10, method='taat'):
+        return self.search_batch([cleaned_query], k, method)[0]
+
+    def search_batch(self, cleaned_queries, k=10, method='taat'):
+        # every shard ranks the whole batch, in one round trip per batch
+        shard_batches = self.broadcast('search_batch', list(cleaned_queries), k, method)
+        return [self.gather(shard_results, k) for shard_results in zip(*shard_batches)]
+
+    def search_phrase(self, cleaned_phrase, k=10, window=None):
+        return self.gather(self.broadcast('search_phrase', cleaned_phrase, k, window), k)
+
+    def search_boolean(self, q_str, k=10):
+        # boolean queries are parsed by the shards, which analyze their terms
+        return self.gather(self.broadcast('search_boolean', q_str, k), k)
+
+    def close(self):
+        # stop the shard worker processes once their merges are done
+        with self.lock:
+            for conn in self.conns:
+                conn.send(None)
+                conn.close()
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='document-sharded index')
+    parser.add_argument('--dbfile', default=ShardedIndex.dbfile)
+    parser.add_argument('--shards', type=int, help='number of shards of a new index')
+    args = parser.parse_args()
+
+    ShardedIndex.dbfile = args.dbfile
+    s = ShardedIndex(num_shards=args.shards)    # starts the shard processes, building the index first if needed
+    code.interact(local=dict(globals(), **locals())) # interactive shell
@@ -0,0 +1,156 @@
+"""
+Single-pass in-memory indexing (SPIMI): postings are collected in memory until a memory budget is
+reached, then written to disk as a run sorted by term id. At the end the runs are merged k-way into
+one stream of complete postings lists in term id order. Postings that fit in memory, like those of a
+small index update, are never written to a run.
+
+A run file holds, for every term in term id order: term id and number of postings (int32 each),
+then the doc ids and the term frequencies (int32 arrays), and when positions are recorded the
+positions of every posting back to back (int32 array of sum(tfs) values).
+"""
+import os
+import heapq
+import shutil
+from array import array
+from itertools import groupby
+import numpy as np
+
+# estimated memory cost of a new term in the in-memory postings, of one posting and of one position
+term_overhead = 200
+posting_overhead = 8
+position_overhead = 4
+
+
+def read_run(path, positions=False):
+    # stream (term id, doc ids, term frequencies, positions or None) from a run file
+    with open(path, 'rb') as f:
+        while True:
+            header = np.fromfile(f, dtype=np.int32, count=2)
+            if len(header) < 2:
+                return
+            term_id, count = int(header[0]), int(header[1])
+            doc_ids = np.fromfile(f, dtype=np.int32, count=count)
+            tfs = np.fromfile(f, dtype=np.int32, count=count)
+            term_positions = np.fromfile(f, dtype=np.int32, count=int(tfs.sum())) if positions else None
+            yield term_id, doc_ids, tfs, term_positions
+
+
+class SpimiInverter:
+    # inverts a stream of documents into postings lists with bounded memory
+
+    def __init__(self, run_dir, memory_budget, positions=False):
+        self.run_dir = run_dir
+        self.memory_budget = memory_budget
+        self.positions = positions  # also record the position of every term occurrence
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir)
+        self.postings = {}      # term id to (doc ids, term frequencies, positions) of the current run
+        self.memory = 0         # estimated bytes held by the current run
+        self.runs = []          # paths of the runs written so far
+
+    def add(self, doc_id, term_ids):
+        # add the postings of one document, doc ids must be increasing
+        unique_ids, tfs = np.unique(term_ids, return_counts=True)
+        if self.positions:
+            # positions grouped by term in the order of unique_ids, increasing within every term
+            order = np.argsort(term_ids, kind='stable').tolist()
+            start = 0
+        for term_id, tf in zip(unique_ids.tolist(), tfs.tolist()):
+            postings = self.postings.get(term_id)
+            if postings is None:
+                postings = self.postings[term_id] = (array('i'), array('i'), array('i'))
+                self.memory += term_overhead
+            postings[0].append(doc_id)
+            postings[1].append(tf)
+            if self.positions:
+                postings[2].extend(order[start:start + tf])
+                start += tf
+        self.memory += posting_overhead * len(unique_ids)
+        if self.positions:
+            self.memory += position_overhead * len(term_ids)
+
+        if self.memory >= self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        # write the current postings as a run sorted by term id and start a new run
+        if not self.postings:
+            return
+        path = os.path.join(self.run_dir, f'run{len(self.runs):05d}.bin')
+        with open(path, 'wb') as f:
+            for term_id in sorted(self.postings):
+                doc_ids, tfs, positions = self.postings[term_id]
+                f.write(np.array([term_id, len(doc_ids)], dtype=np.int32).tobytes())
+                f.write(doc_ids.tobytes())
+                f.write(tfs.tobytes())
+                f.write(positions.tobytes())
+        self.runs.append(path)
+        self.postings = {}
+        self.memory = 0
+
+    def merged(self):
+        # k-way merge of all runs into (term id, doc ids, term frequencies, positions) in term id order,
+        # positions is None unless they are recorded
+        # runs hold increasing doc id ranges, so the parts of a postings list are concatenated in run order
+        self.flush()
+        runs = [read_run(path, self.positions) for path in self.runs]
+        merged = heapq.merge(*runs, key=lambda entry: entry[0])
+        for term_id, parts in groupby(merged, key=lambda entry: entry[0]):
+            parts = list(parts)
+            if len(parts) == 1:
+                yield parts[0]
+            else:
+                yield (term_id, np.concatenate([p[1] for p in parts]), np.concatenate([p[2] for p in parts]),
+                       np.concatenate([p[3] for p in parts]) if self.positions else None)
+
+    def merged_groups(self, max_postings=65536):
+        # merged() in groups of consecutive postings lists holding about max_postings postings, each
+        # group as (term ids, counts, doc ids, term frequencies, positions) with the lists back to back
+        # so that a group can be encoded in one pass; positions is the list of every term's positions or None
+        if not self.runs:
+            # everything fit in memory: the postings are not written to a run and read back, and the
+            # lists of a group are joined straight from their buffers, without an array per list
+            term_ids = sorted(self.postings)
+            start = 0
+            size = 0
+            for end, term_id in enumerate(term_ids, 1):
+                size += len(self.postings[term_id][0])
+                if size >= max_postings or end == len(term_ids):
+                    yield self._join(term_ids[start:end])
+                    start = end
+                    size = 0
+            return
+        group = []
+        size = 0
+        for entry in self.merged():
+            group.append(entry)
+            size += len(entry[1])
+            if size >= max_postings:
+                yield self._concatenate(group)
+                group = []
+                size = 0
+        if group:
+            yield self._concatenate(group)
+
+    def _concatenate(self, group):
+        return (np.array([entry[0] for entry in group], dtype=np.int64),
+                np.array([len(entry[1]) for entry in group], dtype=np.int64),
+                np.concatenate([entry[1] for entry in group]),
+                np.concatenate([entry[2] for entry in group]),
+                [entry[3] for entry in group] if self.positions else None)
+
+    def _join(self, term_ids):
+        lists = [self.postings[term_id] for term_id in term_ids]
+        positions = None
+        if self.positions:
+            ends = np.cumsum([len(term_positions) for _, _, term_positions in lists])
+            positions = np.split(np.frombuffer(b''.join([p[2] for p in lists]), dtype=np.int32), ends[:-1])
+        return (np.array(term_ids, dtype=np.int64),
+                np.array([len(doc_ids) for doc_ids, _, _ in lists], dtype=np.int64),
+                np.frombuffer(b''.join([p[0] for p in lists]), dtype=np.int32),
+                np.frombuffer(b''.join([p[1] for p in lists]), dtype=np.int32),
+                positions)
+
+    def close(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
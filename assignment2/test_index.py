@@ -0,0 +1,124 @@
+"""
+Tests of index updates interleaved with queries, run offline: the NLTK stopwords and lemmatizer are
+replaced by small stand-ins so that no NLTK data is needed, and the index is built in a temporary
+directory from a synthetic corpus instead of the dataset.
+
+    python -m pytest test_index.py
+"""
+import random
+import nltk.corpus
+import nltk.stem
+
+
+class FakeStopwords:
+    def words(self, language):
+        return ['the', 'a', 'of', 'and', 'to', 'in', 'is', 'it']
+
+
+class FakeLemmatizer:
+    # strips a plural 's', enough to give the term cache something to do
+    def lemmatize(self, token):
+        return token[:-1] if token.endswith('s') and len(token) > 3 else token
+
+
+# main and analysis import these names, so they are replaced before main is imported
+nltk.corpus.stopwords = FakeStopwords()
+nltk.stem.WordNetLemmatizer = FakeLemmatizer
+
+import pytest
+import main
+from segment import TieredMergePolicy
+
+queries = ['w1 w5 w20', 'w3 w7', 'w100 w2 w9 w40', 'w250 w1', 'words w33 w8', 'w2 missing']
+k = 10
+
+
+def synthetic_corpus(n, seed):
+    # documents of Zipf distributed words, some with a plural the lemmatizer strips
+    rng = random.Random(seed)
+    words = [f'w{i}' for i in range(400)] + ['words', 'the', 'a', 'of', 'and']
+    weights = [1.0 / (i + 1) for i in range(len(words))]
+    return [' '.join(rng.choices(words, weights, k=rng.randint(5, 120))) for _ in range(n)]
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    # a search agent over a small index merging often, so that merges run between the updates
+    monkeypatch.setattr(main.Indexer, 'dbfile', str(tmp_path / 'ir.idx'))
+    monkeypatch.setattr(main.Indexer, 'num_workers', 1)
+    monkeypatch.setattr(main.Indexer, 'merge_policy', TieredMergePolicy(merge_factor=3, min_segment_docs=20))
+    indexer = main.Indexer(documents=synthetic_corpus(200, seed=1))
+    agent = main.SearchAgent(indexer)
+    yield agent
+    agent.close()
+    indexer.wait_for_merges()
+
+
+def check_queries(agent, deleted):
+    # every method ranks like the reference implementation and never returns a deleted document
+    for q_str in queries:
+        cleaned_query = agent.indexer.clean_text([q_str], query=True)[0]
+        reference_scores = agent.calculate_bm25_scores(cleaned_query)
+        expected = sorted(reference_scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        assert not deleted & set(reference_scores)
+        for method in main.methods:
+            results = list(agent.search(cleaned_query, k, method))
+            assert not deleted & {doc_id for doc_id, _ in results}, (method, q_str)
+            assert len(results) == len(expected), (method, q_str)
+            # the scores match position by position, a document may only trade places with one of equal score
+            for (doc_id, score), (_, expected_score) in zip(results, expected):
+                assert score == pytest.approx(expected_score, rel=1e-5), (method, q_str)
+                assert reference_scores[doc_id] == pytest.approx(score, rel=1e-5), (method, q_str)
+
+
+def test_updates_interleaved_with_queries(agent):
+    indexer = agent.indexer
+    rng = random.Random(2)
+    new_documents = iter(synthetic_corpus(1000, seed=3))
+    live = set(range(200))
+    deleted = set()
+    check_queries(agent, deleted)
+
+    for step in range(30):
+        action = step % 4
+        if action == 0:
+            doc_ids = indexer.add_documents([next(new_documents) for _ in range(rng.randint(1, 40))])
+            assert not live & set(doc_ids) and not deleted & set(doc_ids)
+            live.update(doc_ids)
+        elif action == 1:
+            doc_ids = rng.sample(sorted(live), rng.randint(1, 15))
+            indexer.delete_documents(doc_ids)
+            live.difference_update(doc_ids)
+            deleted.update(doc_ids)
+        elif action == 2:
+            doc_ids = rng.sample(sorted(live), rng.randint(1, 10))
+            new_doc_ids = indexer.update_documents(doc_ids, [next(new_documents) for _ in doc_ids])
+            live.difference_update(doc_ids)
+            deleted.update(doc_ids)
+            live.update(new_doc_ids)
+        else:
+            indexer.wait_for_merges()
+        check_queries(agent, deleted)
+
+        # deleted documents stay deleted
+        for doc_id in rng.sample(sorted(deleted), min(3, len(deleted))):
+            with pytest.raises(KeyError):
+                indexer.get_document(doc_id)
+        assert indexer.corpus_stats['num_docs'] == len(live)
+
+    # the same results once the index is opened again
+    indexer.wait_for_merges()
+    reopened = main.SearchAgent(main.Indexer(documents=()))
+    check_queries(reopened, deleted)
+    assert reopened.indexer.corpus_stats['num_docs'] == len(live)
+
+
+def test_batch_larger_than_result_cache(agent, monkeypatch):
+    # a query found in the result cache when a batch starts can be evicted by the queries before it
+    monkeypatch.setattr(main.SearchAgent, 'result_cache_size', 2)
+    small_cache = main.SearchAgent(agent.indexer)
+    for method in main.methods:
+        small_cache.query_batch(['w1'], k, method)
+        batch = small_cache.query_batch(['w3', 'w5', 'w1'], k, method)
+        for q_str, results in zip(['w3', 'w5', 'w1'], batch):
+            assert list(results) == list(agent.search(q_str, k, method)), (method, q_str)